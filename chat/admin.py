@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Room, Message
+from .models import Room, Message, ClosedRoom, MessageArchive
 
 admin.site.register(Room)
 admin.site.register(Message)
+admin.site.register(ClosedRoom)
+admin.site.register(MessageArchive)
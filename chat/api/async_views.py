@@ -0,0 +1,216 @@
+import json
+import time
+from functools import wraps
+
+from django.http import JsonResponse, QueryDict
+from channels.db import database_sync_to_async
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+
+from ..cache import recent_messages
+from ..metrics import HTTP_REQUEST_SECONDS
+from .. import rooms
+from .serializers import RoomSerializer
+from .views import load_recent_messages, parse_room_codes
+
+
+authentication = JWTStatelessUserAuthentication()
+
+
+def error(message, status_code):
+    return JsonResponse({"error": message}, status=status_code)
+
+
+'''
+Returns the request body of a PUT or POST sent as a json
+object or as an urlencoded form, ValueError for anything else
+'''
+def request_data(request):
+    if request.content_type == "application/json":
+        data = json.loads(request.body or b"{}")
+        if not isinstance(data, dict):
+            raise ValueError("Request body is not an object")
+        return data
+    return QueryDict(request.body)
+
+
+'''
+Turns an async function into an api view that runs on the
+event loop. It allows only the given methods, authenticates
+the user from the JWT without touching the database and
+records the request latency like the sync views.
+The MIDDLEWARE of django 3.2 are sync only, each of their hooks
+still runs in the thread sensitive thread before and after the
+view, so these views save the thread for the view itself only
+'''
+def async_api_view(*methods, authenticated=True):
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            started = time.perf_counter()
+            response = await dispatch(
+                view, methods, authenticated, request, *args, **kwargs
+            )
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started, view.__name__, request.method
+            )
+            return response
+
+        # django.views.decorators.csrf.csrf_exempt would hide
+        # that the view is a coroutine function
+        wrapper.csrf_exempt = True
+        return wrapper
+
+    return decorator
+
+
+async def dispatch(view, methods, authenticated, request, *args, **kwargs):
+    if request.method not in methods:
+        return JsonResponse(
+            {"detail": f'Method "{request.method}" not allowed.'},
+            status=status.HTTP_405_METHOD_NOT_ALLOWED,
+        )
+
+    if authenticated:
+        try:
+            user_auth = authentication.authenticate(request)
+        except AuthenticationFailed as exc:
+            return JsonResponse(
+                {"detail": exc.detail}, status=status.HTTP_401_UNAUTHORIZED
+            )
+        if user_auth is None:
+            return JsonResponse(
+                {"detail": "Authentication credentials were not provided."},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+        request.user = user_auth[0]
+
+    if request.method in ("POST", "PUT"):
+        try:
+            request.data = request_data(request)
+        except ValueError:
+            return error("Invalid request body", status.HTTP_400_BAD_REQUEST)
+
+    return await view(request, *args, **kwargs)
+
+
+'''
+Async variant of GetRoomDetails
+'''
+@async_api_view("GET")
+async def get_room_details(request):
+    code = request.GET.get("code")
+    if code is None:
+        return error("Room code was not provided in url", status.HTTP_404_NOT_FOUND)
+
+    room = await rooms.aget_room(code)
+    if room is None:
+        return error("Room not found, invalid room code", status.HTTP_404_NOT_FOUND)
+    return JsonResponse(RoomSerializer(room).data)
+
+
+'''
+Async variant of GetRoomDetailsBatch
+'''
+@async_api_view("GET")
+async def get_room_details_batch(request):
+    codes = request.GET.get("codes")
+    if codes is None:
+        return error("Room codes were not provided in url", status.HTTP_404_NOT_FOUND)
+    try:
+        codes = parse_room_codes(codes)
+    except ValueError as exc:
+        return error(str(exc), status.HTTP_400_BAD_REQUEST)
+
+    found = await rooms.aget_rooms(codes)
+    return JsonResponse(
+        {
+            code: None if room is None else RoomSerializer(room).data
+            for code, room in found.items()
+        }
+    )
+
+
+'''
+Async variant of JoinRoom
+'''
+@async_api_view("PUT")
+async def join_room(request):
+    code = request.data.get("code")
+    if code is None:
+        return error(
+            "Room code was not provided in the body", status.HTTP_404_NOT_FOUND
+        )
+
+    room, exists = await database_sync_to_async(rooms.join_room)(
+        code, request.user.id
+    )
+    if room is not None:
+        return JsonResponse(RoomSerializer(room).data)
+    if exists:
+        return error("Room is full", status.HTTP_403_FORBIDDEN)
+    return error("Room not found, invalid room code", status.HTTP_404_NOT_FOUND)
+
+
+'''
+Async variant of LeaveRoom
+'''
+@async_api_view("PUT")
+async def leave_room(request):
+    code = request.data.get("code")
+    if code is None:
+        return error(
+            "Room code was not provided in the body", status.HTTP_404_NOT_FOUND
+        )
+
+    if await database_sync_to_async(rooms.leave_room)(code, request.user.id):
+        return JsonResponse({})
+    return error("Room not found, invalid room code", status.HTTP_404_NOT_FOUND)
+
+
+'''
+Async variant of GetRoomMessages, rooms in the recent
+messages cache never leave the event loop
+'''
+@async_api_view("GET")
+async def get_room_messages(request):
+    room_id = request.GET.get("roomId")
+    if room_id is None:
+        return error("Room code was not provided in url", status.HTTP_404_NOT_FOUND)
+
+    data = recent_messages.get(room_id)
+    if data is None:
+        data = await database_sync_to_async(load_recent_messages)(room_id)
+    return JsonResponse(data, safe=False)
+
+
+'''
+Async variant of IsRoomActive
+'''
+@async_api_view("GET", authenticated=False)
+async def is_room_active(request):
+    code = request.GET.get("code")
+    if code is None:
+        return error("Room code was not provided in url", status.HTTP_404_NOT_FOUND)
+
+    if await rooms.aget_room(code) is None:
+        return error("Room not found, invalid room code", status.HTTP_404_NOT_FOUND)
+    return JsonResponse({})
+
+
+'''
+Async variant of IsRoomActiveBatch
+'''
+@async_api_view("GET", authenticated=False)
+async def is_room_active_batch(request):
+    codes = request.GET.get("codes")
+    if codes is None:
+        return error("Room codes were not provided in url", status.HTTP_404_NOT_FOUND)
+    try:
+        codes = parse_room_codes(codes)
+    except ValueError as exc:
+        return error(str(exc), status.HTTP_400_BAD_REQUEST)
+
+    found = await rooms.aget_rooms(codes)
+    return JsonResponse({code: room is not None for code, room in found.items()})
@@ -0,0 +1,31 @@
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+
+from ..metrics import HTTP_REQUEST_QUERIES, HTTP_REQUEST_SECONDS
+
+
+'''
+Records the latency and the number of SQL queries
+of every request a view handles, on every database
+'''
+class InstrumentedMixin:
+    def dispatch(self, request, *args, **kwargs):
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(count_query))
+            response = super().dispatch(request, *args, **kwargs)
+
+        labels = (type(self).__name__, request.method)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, *labels)
+        HTTP_REQUEST_QUERIES.observe(queries, *labels)
+        return response
@@ -0,0 +1,69 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import Q
+
+
+'''
+Encodes the (time_sent, id) position of a message
+into an opaque url safe cursor
+'''
+def encode_cursor(message):
+    value = f"{message.time_sent.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+'''
+Decodes a cursor back into a (time_sent, id) pair,
+raises ValueError if the cursor is malformed
+'''
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode()).decode()
+        time_sent, message_id = value.split("|")
+        return datetime.fromisoformat(time_sent), int(message_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+'''
+Returns one page of messages, newest first, positioned with a
+keyset condition on (time_sent, id) so every page costs one
+index range scan no matter how deep it is. Only one of before
+and after is used, before wins if both are given
+'''
+def paginate_messages(queryset, page_size, before=None, after=None):
+    forward = before is None and after is not None
+    if forward:
+        time_sent, message_id = decode_cursor(after)
+        queryset = (
+            queryset.filter(time_sent__gte=time_sent)
+            .filter(Q(time_sent__gt=time_sent) | Q(id__gt=message_id))
+            .order_by("time_sent", "id")
+        )
+    else:
+        queryset = queryset.order_by("-time_sent", "-id")
+        if before is not None:
+            time_sent, message_id = decode_cursor(before)
+            queryset = queryset.filter(time_sent__lte=time_sent).filter(
+                Q(time_sent__lt=time_sent) | Q(id__lt=message_id)
+            )
+
+    messages = list(queryset[: page_size + 1])
+    has_more = len(messages) > page_size
+    messages = messages[:page_size]
+    if forward:
+        messages.reverse()
+
+    newest = encode_cursor(messages[0]) if messages else None
+    oldest = encode_cursor(messages[-1]) if messages else None
+    if forward:
+        cursors = {"before": oldest, "after": newest if has_more else None}
+    else:
+        cursors = {
+            "before": oldest if has_more else None,
+            "after": newest if before is not None else None,
+        }
+
+    return messages, cursors
@@ -1,7 +1,7 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView, TokenVerifyView
 
-from . import views
+from . import views, async_views
 
 
 app_name = "chat"
@@ -12,9 +12,52 @@ urlpatterns = [
     path("token/verify/", TokenVerifyView.as_view(), name="token_verify"),
     path("token/refresh/", TokenRefreshView.as_view()),
     path("get-room-details/", views.GetRoomDetails.as_view(), name="get-room-details"),
+    path(
+        "get-room-details/batch/",
+        views.GetRoomDetailsBatch.as_view(),
+        name="get-room-details-batch",
+    ),
     path("create-room/", views.CreateRoom.as_view(), name="create-room"),
     path("join-room/", views.JoinRoom.as_view(), name="join-room"),
     path("leave-room/", views.LeaveRoom.as_view(), name="leave-room"),
     path("get-messages/", views.GetRoomMessages.as_view(), name="get-messages"),
+    path(
+        "get-message-history/",
+        views.GetRoomMessageHistory.as_view(),
+        name="get-message-history",
+    ),
     path("is-room-active/", views.IsRoomActive.as_view(), name="is-room-active"),
+    path(
+        "is-room-active/batch/",
+        views.IsRoomActiveBatch.as_view(),
+        name="is-room-active-batch",
+    ),
+    path("metrics/", views.Metrics.as_view(), name="metrics"),
+    path(
+        "async/get-room-details/",
+        async_views.get_room_details,
+        name="async-get-room-details",
+    ),
+    path(
+        "async/get-room-details/batch/",
+        async_views.get_room_details_batch,
+        name="async-get-room-details-batch",
+    ),
+    path("async/join-room/", async_views.join_room, name="async-join-room"),
+    path("async/leave-room/", async_views.leave_room, name="async-leave-room"),
+    path(
+        "async/get-messages/",
+        async_views.get_room_messages,
+        name="async-get-messages",
+    ),
+    path(
+        "async/is-room-active/",
+        async_views.is_room_active,
+        name="async-is-room-active",
+    ),
+    path(
+        "async/is-room-active/batch/",
+        async_views.is_room_active_batch,
+        name="async-is-room-active-batch",
+    ),
 ]
@@ -1,13 +1,22 @@
-import jwt
+import hmac
 
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import BasePermission, IsAuthenticated
 from rest_framework_simplejwt.views import TokenObtainPairView
 
-from config.settings import SECRET_KEY
+from django.conf import settings
+from django.http import HttpResponse
+
 from ..models import Room, Message
+from ..cache import recent_messages
+from ..lifecycle import publish_room_event, room_state
+from ..rooms import get_room, get_rooms, join_room, leave_room
+from ..metrics import render_metrics
+from ..persistence import message_buffer
+from .instrumentation import InstrumentedMixin
+from .pagination import paginate_messages
 from .serializers import (
     RoomSerializer,
     CreateRoomSerializer,
@@ -17,19 +26,48 @@ from .serializers import (
 )
 
 
+'''
+Loads the last 10 messages of a room newest first and
+caches them for the next requests
+'''
+def load_recent_messages(room_id):
+    messages = list(
+        Message.objects.filter(room_id=room_id).order_by("-time_sent", "-id")[:10]
+    )
+    # Messages still waiting in this process' write buffer
+    # are newer than anything the query could see
+    messages += message_buffer.pending_for_room(room_id)
+    messages.sort(key=lambda m: (m.time_sent, m.id), reverse=True)
+    data = MessageSerializer(messages[:10], many=True).data
+    recent_messages.set(room_id, data)
+    return data
+
+
+'''
+Returns the distinct codes of a comma separated list,
+at most CHAT_BATCH_MAX_CODES of them
+'''
+def parse_room_codes(value):
+    codes = list(dict.fromkeys(code.strip() for code in value.split(",")))
+    codes = [code for code in codes if code]
+    if len(codes) > getattr(settings, "CHAT_BATCH_MAX_CODES", 100):
+        raise ValueError("Too many room codes")
+    return codes
+
+
 '''
 This view overrides Simple JWT TokenObtainPairView 
 serializer_class attribute to return user id and username
 in the access token
 '''
-class MyTokenObtainPairView(TokenObtainPairView):
+class MyTokenObtainPairView(InstrumentedMixin, TokenObtainPairView):
     serializer_class = MyTokenObtainSerializer
 
 '''
 This view accepts POST requests and cerates
 a User model instance 
 '''
-class CreateUser(APIView):
+class CreateUser(InstrumentedMixin, APIView):
     serializer_class = UserSerializer
 
     def post(self, request):
@@ -43,16 +81,15 @@ This view accepts GET requests of an authenticated user
 and return the data of the Room model with given code
 '''
 
-class GetRoomDetails(APIView):
+class GetRoomDetails(InstrumentedMixin, APIView):
     serializer_class = RoomSerializer
     permission_classes = (IsAuthenticated,)
 
     def get(self, request):
         code = request.query_params.get("code")
         if code is not None:
-            room_query = Room.objects.filter(code=code)
-            if room_query.exists():
-                room = room_query[0]
+            room = get_room(code)
+            if room is not None:
                 data = self.serializer_class(room).data
                 return Response(data, status=status.HTTP_200_OK)
             return Response(
@@ -64,35 +101,62 @@ class GetRoomDetails(APIView):
             status=status.HTTP_404_NOT_FOUND,
         )
 
+'''
+This view accepts GET requests of an authenticated user
+with a comma separated list of codes and returns the data
+of every room by code, null for codes of no room
+'''
+class GetRoomDetailsBatch(InstrumentedMixin, APIView):
+    serializer_class = RoomSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        codes = request.query_params.get("codes")
+        if codes is None:
+            return Response(
+                {"error": "Room codes were not provided in url"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        try:
+            codes = parse_room_codes(codes)
+        except ValueError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        rooms = get_rooms(codes)
+        return Response(
+            {
+                code: None if room is None else self.serializer_class(room).data
+                for code, room in rooms.items()
+            }
+        )
+
 '''
 This view accepts POST requests of an authenticated user
 and creates a Room model instance
 '''
 
-class CreateRoom(APIView):
+class CreateRoom(InstrumentedMixin, APIView):
     serializer_class = CreateRoomSerializer
     permission_classes = (IsAuthenticated,)
 
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid(raise_exception=True):
-            access_token = request.auth.token
-            token_data = jwt.decode(access_token, SECRET_KEY, algorithms=["HS256"])
-            host_id = token_data["user_id"]
+            host_id = request.user.id
             max_participants = serializer.validated_data.get("max_participants")
-            room_query = Room.objects.filter(host_id=host_id)
-            if room_query.exists():
-                room = room_query[0]
+            room = Room.objects.filter(host_id=host_id).first()
+            if room is not None:
                 room.host_id = host_id
                 room.max_participants = max_participants
-                room.participants = 0
                 room.save(update_fields=["host_id", "max_participants"])
+                publish_room_event(room.code, room_state("updated", room))
                 return Response(
                     RoomSerializer(room).data, status=status.HTTP_201_CREATED
                 )
 
             room = Room(host_id=host_id, max_participants=max_participants)
             room.save()
+            publish_room_event(room.code, room_state("created", room))
             return Response(RoomSerializer(room).data, status=status.HTTP_201_CREATED)
 
 '''
@@ -101,21 +165,18 @@ and increments the participants field of a Room instance
 with the provided code if a room is not full
 '''
 
-class JoinRoom(APIView):
+class JoinRoom(InstrumentedMixin, APIView):
     serializer_class = RoomSerializer
     permission_classes = (IsAuthenticated,)
 
     def put(self, request):
         code = request.data.get("code")
         if code is not None:
-            room_query = Room.objects.filter(code=code)
-            if room_query.exists():
-                room = room_query[0]
-                if room.participants < room.max_participants:
-                    room.participants += 1
-                    room.save(update_fields=["participants"])
-                    serializer = self.serializer_class(room)
-                    return Response(serializer.data, status=status.HTTP_200_OK)
+            room, exists = join_room(code, request.user.id)
+            if room is not None:
+                serializer = self.serializer_class(room)
+                return Response(serializer.data, status=status.HTTP_200_OK)
+            if exists:
                 return Response(
                     {"error": "Room is full"}, status=status.HTTP_403_FORBIDDEN
                 )
@@ -135,24 +196,14 @@ with the given code and destroys the room if the user
 leaving the room is the host
 '''
 
-class LeaveRoom(APIView):
+class LeaveRoom(InstrumentedMixin, APIView):
     serializer_class = RoomSerializer
     permission_classes = (IsAuthenticated,)
 
     def put(self, request):
         code = request.data.get("code")
         if code is not None:
-            room_query = Room.objects.filter(code=code)
-            if room_query.exists():
-                room = room_query[0]
-                access_token = request.auth.token
-                token_data = jwt.decode(access_token, SECRET_KEY, algorithms=["HS256"])
-                host_id = token_data["user_id"]
-                if room.host_id == host_id:
-                    room.delete()
-                else:
-                    room.participants -= 1
-                    room.save(update_fields=["participants"])
+            if leave_room(code, request.user.id):
                 return Response({}, status=status.HTTP_200_OK)
             return Response(
                 {"error": "Room not found, invalid room code"},
@@ -166,36 +217,71 @@ class LeaveRoom(APIView):
 '''
 This view accepts GET requests of an authenticated user
 and return last 10 messages sent in the room with the
-provided id 
+provided id, hot rooms are served from memory
 '''
-class GetRoomMessages(APIView):
+class GetRoomMessages(InstrumentedMixin, APIView):
     serializer_class = MessageSerializer
     permission_classes = (IsAuthenticated,)
 
     def get(self, request):
         room_id = request.query_params.get("roomId")
         if room_id is not None:
-            messages = Message.objects.filter(room_id=room_id).order_by("-time_sent")[
-                :10
-            ]
-            serializer = self.serializer_class(messages, many=True)
-            return Response(serializer.data)
+            data = recent_messages.get(room_id)
+            if data is None:
+                data = load_recent_messages(room_id)
+            return Response(data)
         return Response(
             {"error": "Room code was not provided in url"},
             status=status.HTTP_404_NOT_FOUND,
         )
 
+'''
+This view accepts GET requests of an authenticated user
+and returns a page of messages sent in the room with the
+provided id, older or newer pages are fetched with the
+before and after cursors from the previous response
+'''
+class GetRoomMessageHistory(InstrumentedMixin, APIView):
+    serializer_class = MessageSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        room_id = request.query_params.get("roomId")
+        if room_id is None:
+            return Response(
+                {"error": "Room id was not provided in url"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        try:
+            page_size = int(
+                request.query_params.get("pageSize", settings.CHAT_MESSAGE_PAGE_SIZE)
+            )
+            messages, cursors = paginate_messages(
+                Message.objects.filter(room_id=room_id),
+                page_size=max(1, min(page_size, settings.CHAT_MESSAGE_MAX_PAGE_SIZE)),
+                before=request.query_params.get("before"),
+                after=request.query_params.get("after"),
+            )
+        except ValueError:
+            return Response(
+                {"error": "Invalid page size or cursor"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        serializer = self.serializer_class(messages, many=True)
+        return Response({"messages": serializer.data, **cursors})
+
 '''
 This view accepts GET requests and return a 200 
 status response if a room with provided code
 exists else a 404 response 
 '''
-class IsRoomActive(APIView):
+class IsRoomActive(InstrumentedMixin, APIView):
     def get(self, request):
         code = request.query_params.get("code")
         if code is not None:
-            room_query = Room.objects.filter(code=code)
-            if room_query.exists():
+            if get_room(code) is not None:
                 return Response({}, status=status.HTTP_200_OK)
             return Response(
                 {"error": "Room not found, invalid room code"},
@@ -205,3 +291,49 @@ class IsRoomActive(APIView):
             {"error": "Room code was not provided in url"},
             status=status.HTTP_404_NOT_FOUND,
         )
+
+'''
+This view accepts GET requests with a comma separated
+list of codes and returns if each of the rooms exists
+'''
+class IsRoomActiveBatch(InstrumentedMixin, APIView):
+    def get(self, request):
+        codes = request.query_params.get("codes")
+        if codes is None:
+            return Response(
+                {"error": "Room codes were not provided in url"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        try:
+            codes = parse_room_codes(codes)
+        except ValueError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        rooms = get_rooms(codes)
+        return Response({code: room is not None for code, room in rooms.items()})
+
+'''
+Lets the request through when it carries the bearer token set
+in CHAT_METRICS_TOKEN, or when no token is set
+'''
+class HasMetricsToken(BasePermission):
+    def has_permission(self, request, view):
+        token = getattr(settings, "CHAT_METRICS_TOKEN", None)
+        if not token:
+            return True
+        authorization = request.META.get("HTTP_AUTHORIZATION", "")
+        return hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+
+
+'''
+This view accepts GET requests and returns the chat
+metrics in the prometheus text format
+'''
+class Metrics(APIView):
+    authentication_classes = ()
+    permission_classes = (HasMetricsToken,)
+
+    def get(self, request):
+        return HttpResponse(
+            render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
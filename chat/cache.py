@@ -0,0 +1,76 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from .api.serializers import MessageSerializer
+
+
+'''
+Keeps the last serialized messages of the busiest rooms in
+memory, newest last. Cold rooms are evicted least recently
+used first and every entry expires after ttl seconds, which
+bounds how stale messages saved by other nodes can get
+'''
+class RecentMessageCache:
+    def __init__(self, size=10, max_rooms=1000, ttl=5):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.ttl = ttl
+        self.rooms = OrderedDict()
+        self.lock = threading.Lock()
+
+    '''
+    Returns the cached messages of a room newest first,
+    or None if the room is not cached
+    '''
+    def get(self, room_id):
+        room_id = str(room_id)
+        with self.lock:
+            entry = self.rooms.get(room_id)
+            if entry is None:
+                return None
+            expires_at, messages = entry
+            if expires_at < time.monotonic():
+                del self.rooms[room_id]
+                return None
+            self.rooms.move_to_end(room_id)
+            return list(reversed(messages))
+
+    '''
+    Caches the serialized messages of a room given newest first
+    '''
+    def set(self, room_id, messages):
+        room_id = str(room_id)
+        entry = (time.monotonic() + self.ttl, deque(reversed(messages), self.size))
+        with self.lock:
+            self.rooms[room_id] = entry
+            self.rooms.move_to_end(room_id)
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+
+    '''
+    Appends a newly saved message to its room, rooms that are
+    not cached are skipped so nobody pays to serialize for them
+    '''
+    def add(self, message):
+        room_id = str(message.room_id)
+        if room_id not in self.rooms:
+            return
+        data = MessageSerializer(message).data
+        with self.lock:
+            entry = self.rooms.get(room_id)
+            if entry is not None:
+                entry[1].append(data)
+
+    def clear(self):
+        with self.lock:
+            self.rooms.clear()
+
+
+recent_messages = RecentMessageCache(
+    size=getattr(settings, "CHAT_RECENT_MESSAGES", 10),
+    max_rooms=getattr(settings, "CHAT_RECENT_MESSAGES_ROOMS", 1000),
+    ttl=getattr(settings, "CHAT_RECENT_MESSAGES_TTL", 5),
+)
@@ -0,0 +1,71 @@
+import asyncio
+
+from django.conf import settings
+
+from .codecs import encode_frames
+
+
+'''
+Merges the ephemeral events sent to a room during a tick of
+interval seconds and broadcasts them with one group message.
+Events with the same type from the same user replace each
+other, so only their latest state is sent. Events without a
+type are kept in order
+'''
+class EventCoalescer:
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.rooms = {}
+        self.timers = {}
+        self.tasks = set()
+        self.untyped = 0
+
+    def add(self, code, user, eventData, group_send):
+        kind = eventData.get("type") if isinstance(eventData, dict) else None
+        if kind is None:
+            self.untyped += 1
+            key = (None, self.untyped)
+        else:
+            key = (kind, user)
+
+        events = self.rooms.setdefault(code, {})
+        # A replaced event moves to the end, after the events
+        # that really came before it
+        events.pop(key, None)
+        events[key] = eventData
+
+        if code not in self.timers:
+            self.timers[code] = asyncio.get_running_loop().call_later(
+                self.interval, self.flush, code, group_send
+            )
+
+    def flush(self, code, group_send):
+        self.timers.pop(code, None)
+        events = list(self.rooms.pop(code, {}).values())
+        if not events:
+            return
+
+        task = asyncio.get_running_loop().create_task(
+            group_send(
+                {
+                    "type": "chat_events",
+                    "room": code,
+                    "frames": encode_frames({"room": code, "events": events}),
+                    "event_frames": [
+                        encode_frames({"room": code, "event": eventData})
+                        for eventData in events
+                    ],
+                }
+            )
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def clear(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.rooms.clear()
+        self.timers.clear()
+
+
+event_coalescer = EventCoalescer(interval=getattr(settings, "CHAT_EVENT_TICK", 0.1))
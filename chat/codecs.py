@@ -0,0 +1,88 @@
+import json
+
+import msgpack
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+SUBPROTOCOL_PREFIX = "chat."
+
+
+'''
+Text frames with json, orjson is used when it is installed
+'''
+class JSONCodec:
+    name = "json"
+    binary = False
+
+    def encode(self, data):
+        if orjson is not None:
+            return orjson.dumps(data).decode()
+        return json.dumps(data)
+
+    def decode(self, frame):
+        if orjson is not None:
+            return orjson.loads(frame)
+        return json.loads(frame)
+
+
+'''
+Binary frames with msgpack
+'''
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, frame):
+        return msgpack.unpackb(frame, raw=False)
+
+
+CODECS = {
+    codec.name: codec
+    for codec in (JSONCodec(), MsgpackCodec())
+    if codec.name in getattr(settings, "CHAT_CODECS", ("json", "msgpack"))
+}
+
+DEFAULT_CODEC = CODECS["json"]
+
+
+'''
+Picks the codec of a connection from the "chat.<codec>"
+subprotocols offered by the client, in the client's order of
+preference. Returns the codec and the subprotocol to accept
+'''
+def select_codec(subprotocols):
+    for subprotocol in subprotocols:
+        name = subprotocol[len(SUBPROTOCOL_PREFIX) :]
+        if subprotocol.startswith(SUBPROTOCOL_PREFIX) and name in CODECS:
+            return CODECS[name], subprotocol
+    return DEFAULT_CODEC, None
+
+
+'''
+Encodes an outbound payload as json only, the frames travel with
+the group message. Other codecs are encoded on first use by
+frame_for, most clients speak json
+'''
+def encode_frames(data):
+    return {DEFAULT_CODEC.name: DEFAULT_CODEC.encode(data)}
+
+
+'''
+Returns the frame for the codec, encoding it from the json
+frame the first time. Members of a group on one node share the
+frames dict, so each codec is encoded once per node
+'''
+def frame_for(frames, codec):
+    frame = frames.get(codec.name)
+    if frame is None:
+        data = DEFAULT_CODEC.decode(frames[DEFAULT_CODEC.name])
+        frame = frames[codec.name] = codec.encode(data)
+    return frame
@@ -1,69 +1,457 @@
-import json
+import time
+import asyncio
+from functools import partial
+from urllib.parse import parse_qs
 
+from django.conf import settings
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-from .models import Message
+from .cache import recent_messages
+from .codecs import CODECS, encode_frames, frame_for, select_codec
+from .coalescing import event_coalescer
+from .frames import FrameError, InboundMessage, check_frame, parse_event
+from .lifecycle import LOBBY_GROUP, room_group_name
+from .metrics import (
+    GROUP_SEND_SECONDS,
+    MESSAGE_BROADCAST_SECONDS,
+    WEBSOCKET_CONNECTIONS,
+)
+from .models import CODE_ALPHABET, CODE_LENGTH
+from .persistence import MessageBufferFull, message_buffer
+from .presence import presence
+from .ratelimit import connection_buckets, room_events, room_messages
+from .replay import load_missed_messages, message_data, replay_buffer
+from .db.routers import use_primary
+from .rooms import aget_room
+
+
+def parse_last_seen_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
-   
+
     '''
     Adds the user that connected to the room to
-    a channel where other participants of the room are 
+    a channel where other participants of the room are
     '''
     async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
-        print("connect()")
-        self.room_group_name = f"chat_{self.room_name}"
+        self.room_group_name = room_group_name(self.room_name)
+        query = self.setup()
+        # Reconnecting clients pass the id of the last message
+        # they saw with ?last_seen_id= to get the ones they missed
+        last_seen_id = parse_last_seen_id(query.get("last_seen_id", [None])[0])
+
+        await self.join(self.room_name)
 
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.accept(
+            subprotocol=self.codec_subprotocol or self.scope.get("token_subprotocol")
+        )
+        if last_seen_id is not None:
+            await self.replay(self.room_name, last_seen_id)
 
-        await self.accept()
+    '''
+    Sets up the state of the connection,
+    returns the parsed query string
+    '''
+    def setup(self):
+        self.codec, self.codec_subprotocol = select_codec(self.scope["subprotocols"])
+        # Clients connecting with ?batch=1 get the events of a
+        # tick in one {"events": [...]} frame
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.batch_events = query.get("batch") == ["1"]
+        self.rooms = set()
+        # Room code -> id, None for rooms that do not exist or
+        # closed, looked up once when the room is joined
+        self.room_ids = {}
+        self.replayed = {}
+        self.event_bucket, self.message_bucket = connection_buckets()
+        self.pending_events = {}
+        self.event_timers = {}
+        return query
 
     '''
-    Removes the user from the channel 
+    Removes the user from the channel
     '''
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        # Anything but a normal close means the client went away
+        # without leaving the room, presence gives its seat back
+        for code in list(self.rooms):
+            await self.leave(code, abandoned=close_code != 1000)
+
+    '''
+    Starts receiving the messages and events of a room
+    '''
+    async def join(self, code):
+        # The room may have been created a moment ago, a replica
+        # could still miss it and the id is kept for the connection
+        with use_primary():
+            room = await aget_room(code)
+        self.room_ids[code] = None if room is None else room.id
+        await self.channel_layer.group_add(room_group_name(code), self.channel_name)
+        replay_buffer.join(code)
+        self.rooms.add(code)
+        WEBSOCKET_CONNECTIONS.inc()
+        presence.connect(code, self.presence_key(code), self.user_id())
+
+    async def leave(self, code, abandoned=False):
+        self.rooms.discard(code)
+        self.room_ids.pop(code, None)
+        WEBSOCKET_CONNECTIONS.dec()
+        replay_buffer.leave(code)
+        presence.disconnect(self.presence_key(code), abandoned=abandoned)
+        timer = self.event_timers.pop(code, None)
+        if timer is not None:
+            timer.cancel()
+        self.pending_events.pop(code, None)
+        self.replayed.pop(code, None)
+        await self.channel_layer.group_discard(
+            room_group_name(code), self.channel_name
+        )
 
     '''
-    Receives either an event or message and performs commands 
+    Receives either an event or message and performs commands,
+    binary frames are decoded with the connection's codec.
+    Frames that do not match the schema get an error frame
     '''
-    async def receive(self, text_data):
-        jsonData = json.loads(text_data)
-        eventData = jsonData.get("event")
-        if eventData:
-            await self.channel_layer.group_send(
-                self.room_group_name, {"type": "chat_event", "event": eventData}
+    async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        try:
+            await self.handle_frame(
+                self.room_name, self.decode(text_data, bytes_data), started
             )
-        else:
-            messageData = jsonData.get("message")
-            new_message = await database_sync_to_async(self.create_message)(
-                messageData["user"], messageData["roomId"], messageData["text"]
+        except FrameError as error:
+            await self.send_error(self.room_name, str(error))
+
+    '''
+    Decodes a frame of at most CHAT_MAX_FRAME_SIZE
+    characters or bytes and checks its fields
+    '''
+    def decode(self, text_data, bytes_data):
+        frame = text_data if bytes_data is None else bytes_data
+        max_size = getattr(settings, "CHAT_MAX_FRAME_SIZE", 16384)
+        if frame is None:
+            raise FrameError("Invalid frame")
+        if len(frame) > max_size:
+            raise FrameError("Frame too large")
+        try:
+            if bytes_data is not None and self.codec.binary:
+                frameData = self.codec.decode(bytes_data)
+            else:
+                frameData = CODECS["json"].decode(text_data)
+        except (TypeError, ValueError):
+            raise FrameError("Invalid frame")
+        return check_frame(frameData)
+
+    '''
+    Broadcasts the event or message of a frame. Messages are
+    stored and sent as built from their validated fields, the
+    room id comes from the room the frame was sent to.
+    {"presence": true} asks who is connected to the room
+    '''
+    async def handle_frame(self, code, frameData, started):
+        if "heartbeat" in frameData:
+            return
+        if "presence" in frameData:
+            await self.send_frame(
+                encode_frames(
+                    {
+                        "room": code,
+                        "presence": {
+                            "count": presence.count(code),
+                            "members": presence.members(code),
+                        },
+                    }
+                )
             )
-            messageData["id"] = new_message.id
-            await self.channel_layer.group_send(
-                self.room_group_name, {"type": "chat_message", "message": messageData}
+            return
+        if "event" in frameData:
+            if await self.send_event(code, parse_event(frameData["event"])):
+                MESSAGE_BROADCAST_SECONDS.observe(
+                    time.perf_counter() - started, "event"
+                )
+            return
+
+        message = InboundMessage.parse(frameData.get("message"))
+        if not (self.message_bucket.consume() and room_messages.consume(code)):
+            raise FrameError("Too many messages")
+        room_id = self.room_ids.get(code)
+        if room_id is None:
+            raise FrameError("Room not found")
+        if message.room_id is not None and message.room_id != room_id:
+            raise FrameError("Invalid room id")
+
+        user_id = self.get_user_id(message)
+        await message_buffer.renew_node_id()
+        try:
+            new_message = self.create_message(user_id, room_id, message.text)
+        except MessageBufferFull:
+            raise FrameError("Messages can not be stored right now")
+        await self.group_send(
+            code,
+            {
+                "type": "chat_message",
+                "room": code,
+                "id": new_message.id,
+                "frames": encode_frames(
+                    {"room": code, "message": message_data(new_message)}
+                ),
+            },
+        )
+        MESSAGE_BROADCAST_SECONDS.observe(time.perf_counter() - started, "message")
+
+    def presence_key(self, code):
+        return f"{self.channel_name}#{code}"
+
+    def user_id(self):
+        user = self.scope.get("user")
+        return user.id if user is not None and user.is_authenticated else None
+
+    def user_key(self):
+        user_id = self.user_id()
+        return self.channel_name if user_id is None else user_id
+
+    '''
+    Broadcasts an event if the connection and the room are
+    under their event rate. Otherwise the event is kept, later
+    events replace it and the last one is sent once allowed
+    '''
+    async def send_event(self, code, eventData):
+        if self.event_bucket.consume() and room_events.consume(code):
+            if event_coalescer.interval:
+                event_coalescer.add(
+                    code, self.user_key(), eventData, partial(self.group_send, code)
+                )
+            else:
+                await self.group_send(
+                    code,
+                    {
+                        "type": "chat_event",
+                        "frames": encode_frames({"room": code, "event": eventData}),
+                    },
+                )
+            return True
+
+        self.pending_events[code] = eventData
+        if code not in self.event_timers:
+            self.event_timers[code] = asyncio.get_running_loop().call_later(
+                max(self.event_bucket.delay(), 0.01), self.send_pending_event, code
+            )
+        return False
+
+    def send_pending_event(self, code):
+        self.event_timers.pop(code, None)
+        eventData = self.pending_events.pop(code, None)
+        if eventData is not None:
+            self.event_task = asyncio.get_running_loop().create_task(
+                self.send_event(code, eventData)
+            )
+
+    '''
+    Sends a message to everyone in the room
+    '''
+    async def group_send(self, code, message):
+        started = time.perf_counter()
+        await self.channel_layer.group_send(room_group_name(code), message)
+        GROUP_SEND_SECONDS.observe(time.perf_counter() - started)
+
+    '''
+    Sends the messages sent after last_seen_id, from the replay
+    buffer when it still has them and from the database if not.
+    Messages broadcast meanwhile wait in the channel layer and
+    are sent afterwards, the ones already replayed are skipped
+    '''
+    async def replay(self, code, last_seen_id):
+        missed = replay_buffer.since(code, last_seen_id)
+        if missed is None:
+            room_id = self.room_ids.get(code)
+            if room_id is None:
+                return
+            missed = await database_sync_to_async(load_missed_messages)(
+                room_id, code, last_seen_id, getattr(settings, "CHAT_REPLAY_LIMIT", 500)
             )
+        replayed = self.replayed.setdefault(code, set())
+        for message_id, frames in missed:
+            replayed.add(message_id)
+            await self.write_frame(frame_for(frames, self.codec))
+
     '''
-    Sends the message to the websocket  
+    Sends the message to the websocket
     '''
     async def chat_message(self, event):
-        messageData = event["message"]
-        await self.send(text_data=json.dumps({"message": messageData}))
-    
+        replay_buffer.add(event["room"], event["id"], event["frames"])
+        if event["id"] in self.replayed.get(event["room"], ()):
+            return
+        await self.send_frame(event["frames"])
+
+    '''
+    Sends the event to the websocket
+    '''
+    async def chat_event(self, event):
+        await self.send_frame(event["frames"])
+
+    '''
+    Sends a lifecycle event of the room, like a change of its
+    participants or the room being closed by its host. Once
+    the room closed, messages sent to it are refused
+    '''
+    async def room_event(self, event):
+        if event.get("kind") == "closed" and event["room"] in self.room_ids:
+            self.room_ids[event["room"]] = None
+        await self.send_frame(event["frames"])
+
+    '''
+    The channel layer dropped the backlog of this connection,
+    the client reads slower than its rooms talk
+    '''
+    async def channel_overflow(self, event):
+        await self.close(code=1013)
+
+    '''
+    Sends the events of a tick, in one frame to clients
+    that asked for batches and one by one to the others
+    '''
+    async def chat_events(self, event):
+        if self.batch_events:
+            await self.send_frame(event["frames"])
+        else:
+            for frames in event["event_frames"]:
+                await self.send_frame(frames)
+
     '''
-    Sends the event to the websocket  
+    Sends the frame pre-encoded for the connection's codec
     '''
-    async def chat_event(self, event):  
-        eventData = event["event"]
-        await self.send(text_data=json.dumps({"event": eventData}))
+    async def send_frame(self, frames):
+        await self.write_frame(frame_for(frames, self.codec))
+
+    async def send_error(self, code, error):
+        await self.send_frame(encode_frames({"room": code, "error": error}))
+
+    async def write_frame(self, frame):
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
 
     '''
-    Saves the message in database  
+    Returns the id of the user the access token was issued to.
+    Clients connected without a token may only send messages
+    with CHAT_ANONYMOUS_MESSAGES on, naming themselves
+    '''
+    def get_user_id(self, message):
+        user_id = self.user_id()
+        if user_id is not None:
+            return user_id
+        if not getattr(settings, "CHAT_ANONYMOUS_MESSAGES", False):
+            raise FrameError("Sign in to send messages")
+        if message.user is None:
+            raise FrameError("Missing user")
+        return message.user
+
+    '''
+    Queues the message for a batched database write,
+    the returned message already has its id
     '''
     def create_message(self, user_id, room_id, text):
-        created_message = Message.objects.create(
+        created_message = message_buffer.add(
             room_id=room_id, user_id=user_id, text=text
         )
+        recent_messages.add(created_message)
         return created_message
+
+
+'''
+One connection for any number of rooms. Clients send
+{"subscribe": code, "last_seen_id": id} and {"unsubscribe": code},
+and tag the messages and events they send with {"room": code}.
+Every frame sent to the client carries the code of its room
+'''
+class MultiplexChatConsumer(ChatConsumer):
+    async def connect(self):
+        self.setup()
+        await self.accept(
+            subprotocol=self.codec_subprotocol or self.scope.get("token_subprotocol")
+        )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        code = None
+        try:
+            frameData = self.decode(text_data, bytes_data)
+            code = frameData.get("room")
+
+            if "subscribe" in frameData:
+                code = frameData["subscribe"]
+                last_seen_id = parse_last_seen_id(frameData.get("last_seen_id"))
+                await self.subscribe(code, last_seen_id)
+            elif "unsubscribe" in frameData:
+                code = frameData["unsubscribe"]
+                if isinstance(code, str) and code in self.rooms:
+                    await self.leave(code)
+            elif isinstance(code, str) and code in self.rooms:
+                await self.handle_frame(code, frameData, started)
+            elif "heartbeat" in frameData and code is None:
+                pass
+            else:
+                raise FrameError("Not subscribed to the room")
+        except FrameError as error:
+            await self.send_error(code if isinstance(code, str) else None, str(error))
+
+    async def subscribe(self, code, last_seen_id):
+        if not (
+            isinstance(code, str)
+            and len(code) == CODE_LENGTH
+            and all(char in CODE_ALPHABET for char in code)
+        ):
+            raise FrameError("Invalid room code")
+        if code in self.rooms:
+            return
+        if len(self.rooms) >= getattr(settings, "CHAT_MULTIPLEX_MAX_ROOMS", 50):
+            raise FrameError("Too many rooms")
+
+        await self.join(code)
+        await self.write_frame(
+            frame_for(encode_frames({"room": code, "subscribed": True}), self.codec)
+        )
+        if last_seen_id is not None:
+            await self.replay(code, last_seen_id)
+
+
+'''
+Sends the lifecycle events of every room, created, updated,
+closed and participant changes, to signed in clients listing
+rooms. Connections are refused while CHAT_LOBBY_EVENTS is off
+'''
+class LobbyConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        user = self.scope.get("user")
+        if (
+            not getattr(settings, "CHAT_LOBBY_EVENTS", False)
+            or user is None
+            or not user.is_authenticated
+        ):
+            await self.close()
+            return
+        self.codec, subprotocol = select_codec(self.scope["subprotocols"])
+        await self.channel_layer.group_add(LOBBY_GROUP, self.channel_name)
+        await self.accept(
+            subprotocol=subprotocol or self.scope.get("token_subprotocol")
+        )
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(LOBBY_GROUP, self.channel_name)
+
+    async def channel_overflow(self, event):
+        await self.close(code=1013)
+
+    async def room_event(self, event):
+        frame = frame_for(event["frames"], self.codec)
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
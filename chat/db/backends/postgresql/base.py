@@ -0,0 +1,52 @@
+from django.db.backends.postgresql import base
+
+from ...pool import get_pool, pools
+
+
+def check_connection(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1")
+    if not connection.autocommit:
+        connection.rollback()
+    return True
+
+
+'''
+PostgreSQL backend that takes its connections from a process
+wide pool and gives them back when django closes them. Keep
+CONN_MAX_AGE at 0 so connections go back to the pool after
+every request and every database_sync_to_async call, which is
+what makes the pool size and not the thread count bound the
+number of open connections. Configured with the POOL key of
+the database settings: SIZE, TIMEOUT and CHECK_INTERVAL
+'''
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_pool(self, conn_params):
+        options = self.settings_dict.get("POOL", {})
+        return get_pool(
+            self.alias,
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+            size=options.get("SIZE", 10),
+            timeout=options.get("TIMEOUT", 10),
+            check_interval=options.get("CHECK_INTERVAL", 30),
+            check=check_connection,
+        )
+
+    def get_new_connection(self, conn_params):
+        connection = self.get_pool(conn_params).acquire()
+        self.isolation_level = self.settings_dict["OPTIONS"].get(
+            "isolation_level", connection.isolation_level
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        connection = self.connection
+        discard = bool(connection.closed) or self.errors_occurred
+        if not discard:
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+        pools[self.alias].release(connection, discard)
@@ -0,0 +1,150 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from django.db import OperationalError
+
+
+logger = logging.getLogger(__name__)
+
+# Pools of this process by database alias
+pools = {}
+pools_lock = threading.Lock()
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+'''
+Thread safe pool of database connections. At most size
+connections are open, threads wait up to timeout seconds for
+one to come back. Connections that sat idle longer than
+check_interval seconds are checked before they are handed out
+and replaced when the check fails
+'''
+class ConnectionPool:
+    def __init__(self, connect, size=10, timeout=10, check_interval=30, check=None):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.check = check
+        self.idle = deque()
+        self.opened = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while not self.idle and self.opened >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        f"No database connection free after {self.timeout}s"
+                    )
+                self.waiting += 1
+                try:
+                    self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.in_use += 1
+            if self.idle:
+                # The most recently used connection is the least
+                # likely to have been dropped by the server
+                connection, idle_since = self.idle.pop()
+            else:
+                self.opened += 1
+                connection, idle_since = None, None
+
+        try:
+            if connection is not None and not self.is_healthy(connection, idle_since):
+                self.close_connection(connection)
+                connection = None
+            if connection is None:
+                connection = self.connect()
+        except BaseException:
+            self.forget()
+            raise
+        return connection
+
+    def release(self, connection, discard=False):
+        if discard:
+            self.close_connection(connection)
+            self.forget()
+            return
+
+        with self.condition:
+            self.in_use -= 1
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    '''
+    Gives up the slot of a connection that was closed
+    or never opened, so another one can be opened
+    '''
+    def forget(self):
+        with self.condition:
+            self.in_use -= 1
+            self.opened -= 1
+            self.condition.notify()
+
+    def is_healthy(self, connection, idle_since):
+        if self.check is None or time.monotonic() - idle_since < self.check_interval:
+            return True
+        try:
+            return self.check(connection)
+        except Exception:
+            return False
+
+    def close_connection(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            logger.warning("Could not close a pooled connection", exc_info=True)
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, deque()
+            self.opened -= len(idle)
+        for connection, _ in idle:
+            self.close_connection(connection)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "size": self.size,
+                "open": self.opened,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "waiting": self.waiting,
+            }
+
+
+'''
+Returns the pool of a database alias, creating it
+with the given options the first time
+'''
+def get_pool(alias, connect, **options):
+    pool = pools.get(alias)
+    if pool is None:
+        with pools_lock:
+            pool = pools.get(alias)
+            if pool is None:
+                pool = pools[alias] = ConnectionPool(connect, **options)
+    return pool
+
+
+'''
+Returns the stats of every pool by (alias, stat)
+'''
+def pool_stats():
+    return {
+        (alias, name): value
+        for alias, pool in list(pools.items())
+        for name, value in pool.stats().items()
+    }
@@ -0,0 +1,143 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.functional import SimpleLazyObject
+
+# The request being served in this context, set by the middleware
+current_request = ContextVar("current_request", default=None)
+
+# Set once the request wrote, its reads then go to the primary
+primary_pinned = ContextVar("primary_pinned", default=False)
+
+
+def replicas():
+    return getattr(settings, "CHAT_DATABASE_REPLICAS", ())
+
+
+def sticky_key(user_id):
+    return f"chat:db:primary:{user_id}"
+
+
+'''
+Returns the id of the user the api view authenticated, or
+None before that. The lazy session user set by django's
+AuthenticationMiddleware is left alone, it costs queries
+'''
+def request_user_id(request):
+    user = request.__dict__.get("user")
+    if user is None or isinstance(user, SimpleLazyObject):
+        return None
+    return user.id if user.is_authenticated else None
+
+
+'''
+Sends the reads of the given users to the primary for the next
+CHAT_REPLICA_STICKY_SECONDS, after they wrote outside a request
+'''
+def mark_primary(user_ids):
+    if replicas() and user_ids:
+        cache.set_many(
+            {sticky_key(user_id): True for user_id in user_ids},
+            getattr(settings, "CHAT_REPLICA_STICKY_SECONDS", 5),
+        )
+
+
+'''
+Sends reads to the primary inside the block, for code
+outside requests that reads what was just written
+'''
+@contextmanager
+def use_primary():
+    token = primary_pinned.set(True)
+    try:
+        yield
+    finally:
+        primary_pinned.reset(token)
+
+
+'''
+Sends writes to the default database and reads to one of the
+CHAT_DATABASE_REPLICAS. Reads go to the primary inside
+transactions, in a request that already wrote and, for
+CHAT_REPLICA_STICKY_SECONDS after a user's write, in every
+request of that user, so users always read their own writes
+'''
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if not aliases or self.reads_primary():
+            return DEFAULT_DB_ALIAS
+        return random.choice(aliases)
+
+    def reads_primary(self):
+        if primary_pinned.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return True
+        request = current_request.get()
+        if request is None:
+            return False
+        # The marker is looked up once per request, once the
+        # view authenticated its user
+        if not hasattr(request, "replica_sticky"):
+            user_id = request_user_id(request)
+            if user_id is None:
+                return False
+            request.replica_sticky = bool(cache.get(sticky_key(user_id)))
+        return request.replica_sticky
+
+    def db_for_write(self, model, **hints):
+        request = current_request.get()
+        if not replicas() or request is None:
+            return DEFAULT_DB_ALIAS
+        primary_pinned.set(True)
+        request.replica_sticky = True
+        if not getattr(request, "replica_marked", False):
+            request.replica_marked = True
+            user_id = request_user_id(request)
+            if user_id is not None:
+                mark_primary([user_id])
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replicas():
+            return False
+        return None
+
+
+'''
+Gives every request a fresh routing context, so a request is
+only pinned to the primary by its own writes or its user's
+'''
+@sync_and_async_middleware
+def replica_routing_middleware(get_response):
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            request_token = current_request.set(request)
+            pinned_token = primary_pinned.set(False)
+            try:
+                return await get_response(request)
+            finally:
+                primary_pinned.reset(pinned_token)
+                current_request.reset(request_token)
+
+    else:
+
+        def middleware(request):
+            request_token = current_request.set(request)
+            pinned_token = primary_pinned.set(False)
+            try:
+                return get_response(request)
+            finally:
+                primary_pinned.reset(pinned_token)
+                current_request.reset(request_token)
+
+    return middleware
@@ -0,0 +1,107 @@
+from django.conf import settings
+
+
+FRAME_FIELDS = frozenset(
+    (
+        "message",
+        "event",
+        "heartbeat",
+        "presence",
+        "room",
+        "subscribe",
+        "unsubscribe",
+        "last_seen_id",
+    )
+)
+
+MESSAGE_FIELDS = frozenset(("user", "roomId", "text"))
+
+EVENT_SCALARS = (str, int, float, bool, type(None))
+
+
+'''
+Raised for frames that do not match the schema, the
+consumers answer them with an error frame
+'''
+class FrameError(ValueError):
+    pass
+
+
+'''
+Checks that a decoded frame is an object made
+only of the fields the consumers understand
+'''
+def check_frame(frameData):
+    if not isinstance(frameData, dict):
+        raise FrameError("Invalid frame")
+    if not FRAME_FIELDS.issuperset(frameData):
+        raise FrameError("Unknown frame fields")
+    return frameData
+
+
+def parse_id(value, name):
+    if isinstance(value, bool):
+        raise FrameError(f"Invalid {name}")
+    # str.isdigit is also true for digits int() refuses, like "²"
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        value = int(value)
+    if not isinstance(value, int) or value <= 0:
+        raise FrameError(f"Invalid {name}")
+    return value
+
+
+'''
+A chat message sent by a client. Only user, roomId and text
+are accepted and text is capped at CHAT_MAX_MESSAGE_LENGTH
+characters. user and roomId may be left out, they are then
+taken from the token and the room of the connection
+'''
+class InboundMessage:
+    __slots__ = ("user", "room_id", "text")
+
+    def __init__(self, user, room_id, text):
+        self.user = user
+        self.room_id = room_id
+        self.text = text
+
+    @classmethod
+    def parse(cls, messageData):
+        if not isinstance(messageData, dict):
+            raise FrameError("Invalid message")
+        if not MESSAGE_FIELDS.issuperset(messageData):
+            raise FrameError("Unknown message fields")
+
+        text = messageData.get("text")
+        if not isinstance(text, str) or not text.strip():
+            raise FrameError("Message text is missing")
+        if len(text) > getattr(settings, "CHAT_MAX_MESSAGE_LENGTH", 2000):
+            raise FrameError("Message text is too long")
+
+        user = messageData.get("user")
+        room_id = messageData.get("roomId")
+        return cls(
+            user=None if user is None else parse_id(user, "user"),
+            room_id=None if room_id is None else parse_id(room_id, "room id"),
+            text=text,
+        )
+
+
+'''
+Returns a copy of an ephemeral event, which has to be a flat
+object of at most CHAT_MAX_EVENT_FIELDS short scalar fields
+'''
+def parse_event(eventData):
+    if not isinstance(eventData, dict):
+        raise FrameError("Invalid event")
+    if len(eventData) > getattr(settings, "CHAT_MAX_EVENT_FIELDS", 8):
+        raise FrameError("Too many event fields")
+
+    max_length = getattr(settings, "CHAT_MAX_EVENT_VALUE_LENGTH", 256)
+    for name, value in eventData.items():
+        if not isinstance(name, str) or len(name) > 32:
+            raise FrameError("Invalid event field")
+        if not isinstance(value, EVENT_SCALARS):
+            raise FrameError("Invalid event value")
+        if isinstance(value, str) and len(value) > max_length:
+            raise FrameError("Event value is too long")
+    return dict(eventData)
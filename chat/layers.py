@@ -0,0 +1,264 @@
+import time
+import asyncio
+import random
+import string
+import logging
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW = {"type": "channel.overflow"}
+
+
+'''
+Channel layer for nodes that hold most of a room's members. The
+channels and groups of this process live in memory and group_send
+hands messages straight to local members. A remote layer (Redis in
+production) is only used to reach other nodes: a node joins each
+group on the remote layer once, with its node channel, and tells
+the other nodes in the group about it. Group messages are only
+published remotely when another node is known to be in the group
+or when this node has no members of its own in it.
+
+Like InMemoryChannelLayer, a channel whose oldest message waited
+longer than expiry seconds is dropped, so the queues of consumers
+that went away do not pile up. Remote groups forget members after
+their group_expiry, the node joins its groups again every
+group_refresh seconds
+'''
+class LocalFanoutChannelLayer(BaseChannelLayer):
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        remote=None,
+        expiry=60,
+        capacity=100,
+        channel_capacity=None,
+        group_refresh=3600,
+        **kwargs
+    ):
+        super().__init__(
+            expiry=expiry, capacity=capacity, channel_capacity=channel_capacity
+        )
+        if isinstance(remote, dict):
+            remote = import_string(remote["BACKEND"])(**remote.get("CONFIG", {}))
+        self.remote = remote
+        self.group_refresh = group_refresh
+        self.channels = {}
+        self.groups = {}
+        self.remote_nodes = {}
+        self.node_channel = None
+        self.starting = None
+        self.reader = None
+        self.refresher = None
+        self.cleaned_at = time.monotonic()
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        await self.start()
+        if self.remote is not None and not self.is_local(channel) and "!" in channel:
+            await self.remote.send(
+                self.owner_node(channel),
+                {"type": "node.send", "channel": channel, "message": message},
+            )
+            return
+        self.put(channel, message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        await self.start()
+
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        try:
+            _, message = await queue.get()
+            return message
+        finally:
+            if queue.empty() and self.channels.get(channel) is queue:
+                del self.channels[channel]
+
+    async def new_channel(self, prefix="specific."):
+        await self.start()
+        return f"{self.node_channel}.{self.random_name()}"
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        await self.start()
+        members = self.groups.setdefault(group, set())
+        members.add(channel)
+        if len(members) == 1 and self.remote is not None:
+            await self.remote.group_add(group, self.node_channel)
+            await self.remote.group_send(group, self.node_message("node.join", group))
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        members = self.groups.get(group)
+        if members is None or channel not in members:
+            return
+        members.discard(channel)
+        if not members:
+            del self.groups[group]
+            self.remote_nodes.pop(group, None)
+            if self.remote is not None:
+                await self.remote.group_discard(group, self.node_channel)
+                await self.remote.group_send(
+                    group, self.node_message("node.leave", group)
+                )
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+
+        await self.start()
+        self.deliver(group, message)
+        if self.remote is not None and (
+            self.remote_nodes.get(group) or group not in self.groups
+        ):
+            await self.remote.group_send(
+                group, dict(self.node_message("node.group", group), message=message)
+            )
+
+    # Flush extension
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+        self.remote_nodes = {}
+        if self.remote is not None:
+            await self.remote.flush()
+
+    async def close(self):
+        for task in (self.reader, self.refresher):
+            if task is not None:
+                task.cancel()
+        self.reader = self.refresher = None
+        if self.remote is not None:
+            await self.remote.close()
+
+    # Local delivery
+
+    def is_local(self, channel):
+        return self.node_channel is not None and channel.startswith(
+            self.node_channel + "."
+        )
+
+    def owner_node(self, channel):
+        return channel.rsplit(".", 1)[0]
+
+    def random_name(self):
+        return "".join(random.choices(string.ascii_letters, k=12))
+
+    def put(self, channel, message):
+        now = time.monotonic()
+        if now - self.cleaned_at > self.expiry:
+            self.clean_expired(now)
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.put_nowait((now + self.expiry, message))
+
+    '''
+    Drops the channels whose oldest message expired, nobody
+    has received from them for expiry seconds
+    '''
+    def clean_expired(self, now):
+        self.cleaned_at = now
+        for channel, queue in list(self.channels.items()):
+            if not queue.empty() and queue._queue[0][0] < now:
+                del self.channels[channel]
+
+    '''
+    Hands a group message to every local member. Members share
+    the same message dict, consumers must not change it besides
+    caching the frames of their codec (codecs.frame_for). A member
+    that fell capacity messages behind loses its backlog and gets
+    a channel.overflow message, so the consumer can disconnect
+    instead of silently missing messages
+    '''
+    def deliver(self, group, message):
+        for channel in self.groups.get(group, ()):
+            try:
+                self.put(channel, message)
+            except ChannelFull:
+                self.overflow(channel)
+
+    def overflow(self, channel):
+        queue = self.channels[channel]
+        if queue.qsize() == 1 and queue._queue[0][1] is OVERFLOW:
+            return
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait((time.monotonic() + self.expiry, OVERFLOW))
+
+    # Remote nodes
+
+    def node_message(self, kind, group):
+        return {"type": kind, "origin": self.node_channel, "group": group}
+
+    async def start(self):
+        if self.node_channel is not None:
+            return
+        if self.remote is None:
+            self.node_channel = f"specific.local!{self.random_name()}"
+            return
+        # Several coroutines can get here before the remote answers,
+        # they all wait for the same node channel
+        if self.starting is None:
+            self.starting = asyncio.ensure_future(self.remote.new_channel())
+        node_channel = await asyncio.shield(self.starting)
+        if self.node_channel is None:
+            self.node_channel = node_channel
+            loop = asyncio.get_running_loop()
+            self.reader = loop.create_task(self.read_remote())
+            self.refresher = loop.create_task(self.refresh_groups())
+
+    async def refresh_groups(self):
+        while True:
+            await asyncio.sleep(self.group_refresh)
+            for group in list(self.groups):
+                try:
+                    await self.remote.group_add(group, self.node_channel)
+                except Exception:
+                    logger.exception("Could not refresh the remote group %s", group)
+
+    async def read_remote(self):
+        while True:
+            message = await self.remote.receive(self.node_channel)
+            try:
+                await self.handle_remote(message)
+            except Exception:
+                logger.exception("Could not handle %s from the remote layer", message)
+
+    async def handle_remote(self, message):
+        kind, origin = message["type"], message.get("origin")
+        if kind == "node.send":
+            self.put(message["channel"], message["message"])
+            return
+        if origin == self.node_channel:
+            return
+
+        group = message["group"]
+        if kind == "node.group":
+            self.deliver(group, message["message"])
+        elif kind == "node.join":
+            self.remote_nodes.setdefault(group, set()).add(origin)
+            await self.remote.send(origin, self.node_message("node.present", group))
+        elif kind == "node.present":
+            if group in self.groups:
+                self.remote_nodes.setdefault(group, set()).add(origin)
+        elif kind == "node.leave":
+            self.remote_nodes.get(group, set()).discard(origin)
@@ -0,0 +1,61 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .codecs import encode_frames
+
+
+logger = logging.getLogger(__name__)
+
+LOBBY_GROUP = "chat_lobby"
+
+
+def room_group_name(code):
+    return f"chat_{code}"
+
+
+'''
+The state of a room sent with its lifecycle events
+'''
+def room_state(kind, room):
+    return {
+        "type": kind,
+        "participants": room.participants,
+        "max_participants": room.max_participants,
+    }
+
+
+'''
+Sends a lifecycle event of a room to the room's group and,
+with CHAT_LOBBY_EVENTS on, to the lobby group. Events are
+best effort, a failing channel layer is only logged
+'''
+async def send_room_event(code, eventData):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    message = {
+        "type": "room_event",
+        "room": code,
+        "kind": eventData["type"],
+        "frames": encode_frames({"room": code, "room_event": eventData}),
+    }
+    groups = [room_group_name(code)]
+    if getattr(settings, "CHAT_LOBBY_EVENTS", False):
+        groups.append(LOBBY_GROUP)
+    try:
+        for group in groups:
+            await channel_layer.group_send(group, message)
+    except Exception:
+        logger.exception("Could not send the %s event of room %s", eventData, code)
+
+
+'''
+Publishes the event once the current transaction commits,
+so clients never hear of changes that were rolled back
+'''
+def publish_room_event(code, eventData):
+    transaction.on_commit(lambda: async_to_sync(send_room_event)(code, eventData))
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.retention import run_retention
+
+
+'''
+Archives the messages of closed rooms and the messages older
+than CHAT_MESSAGE_RETENTION_DAYS, meant to run from cron
+'''
+class Command(BaseCommand):
+    help = "Archives or deletes messages of closed rooms and expired messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size", type=int, default=settings.CHAT_RETENTION_CHUNK_SIZE
+        )
+        parser.add_argument(
+            "--days", type=int, default=settings.CHAT_MESSAGE_RETENTION_DAYS
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to wait between chunks",
+        )
+        parser.add_argument("--max-chunks", type=int, default=None)
+        parser.add_argument(
+            "--no-archive",
+            action="store_false",
+            dest="archive",
+            default=settings.CHAT_ARCHIVE_MESSAGES,
+            help="Delete messages instead of moving them to the archive",
+        )
+
+    def handle(self, *args, **options):
+        totals = run_retention(
+            chunk_size=options["chunk_size"],
+            retention_days=options["days"],
+            archive=options["archive"],
+            closed_delay=settings.CHAT_CLOSED_ROOM_DELAY,
+            pause=options["pause"],
+            max_chunks=options["max_chunks"],
+        )
+        self.stdout.write(
+            "Cleaned up {closed_rooms} closed rooms with {closed_room_messages} "
+            "messages and {expired_messages} expired messages".format(**totals)
+        )
@@ -0,0 +1,201 @@
+import threading
+from bisect import bisect_left
+
+from .db.pool import pool_stats
+
+
+registry = []
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5
+)
+
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+
+'''
+Base class of the metrics. Every thread writes to its own shard,
+so updates never take a lock or contend, and a scrape adds the
+shards up. Each shard maps a tuple of label values to a value
+'''
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.shards = {}
+        registry.append(self)
+
+    def shard(self):
+        ident = threading.get_ident()
+        shard = self.shards.get(ident)
+        if shard is None:
+            shard = self.shards[ident] = {}
+        return shard
+
+    def snapshots(self):
+        return [dict(shard) for shard in list(self.shards.values())]
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join(
+            '%s="%s"' % (name, escape_label(value)) for name, value in pairs
+        )
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        lines.extend(self.render_samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, *labels):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self):
+        totals = {}
+        for shard in self.snapshots():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render_samples(self):
+        for labels, value in sorted(self.values().items()):
+            yield f"{self.name}{self.format_labels(labels)} {value}"
+
+
+'''
+A counter that can go down. Series that are back to zero are
+left out of the scrape, so short lived labels like rooms do not
+pile up
+'''
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+    def render_samples(self):
+        for labels, value in sorted(self.values().items()):
+            if value:
+                yield f"{self.name}{self.format_labels(labels)} {value}"
+
+
+'''
+A gauge whose value is read from a function at scrape time,
+the function returns a map of label values to value
+'''
+class CallbackGauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def render_samples(self):
+        for labels, value in sorted(self.callback().items()):
+            yield f"{self.name}{self.format_labels(labels)} {value}"
+
+
+'''
+Histogram over fixed buckets. A shard keeps the bucket counts
+followed by the sum and the count of the observations
+'''
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self.shard()
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 3)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def values(self):
+        totals = {}
+        for shard in self.snapshots():
+            for labels, counts in shard.items():
+                total = totals.setdefault(labels, [0] * len(counts))
+                for index, count in enumerate(list(counts)):
+                    total[index] += count
+        return totals
+
+    def render_samples(self):
+        for labels, counts in sorted(self.values().items()):
+            cumulative = 0
+            bounds = [str(bucket) for bucket in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                bucket_labels = self.format_labels(labels, [("le", bound)])
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{self.format_labels(labels)} {counts[-2]}"
+            yield f"{self.name}_count{self.format_labels(labels)} {counts[-1]}"
+
+
+def escape_label(value):
+    return (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    )
+
+
+'''
+Renders every registered metric in the prometheus text format
+'''
+def render_metrics():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# Not labelled by room, the scrape would list every room code
+WEBSOCKET_CONNECTIONS = Gauge(
+    "chat_websocket_connections", "Open websocket room connections"
+)
+
+MESSAGE_BROADCAST_SECONDS = Histogram(
+    "chat_message_broadcast_seconds",
+    "Time from receiving a frame to handing it to the channel layer",
+    ("kind",),
+)
+
+GROUP_SEND_SECONDS = Histogram(
+    "chat_group_send_seconds", "Time spent in channel layer group_send"
+)
+
+MESSAGE_WRITE_SECONDS = Histogram(
+    "chat_message_write_seconds", "Time spent writing a batch of messages"
+)
+
+MESSAGES_WRITTEN = Counter("chat_messages_written_total", "Messages written")
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "chat_http_request_seconds", "Api request latency", ("view", "method")
+)
+
+HTTP_REQUEST_QUERIES = Histogram(
+    "chat_http_request_queries",
+    "SQL queries run by an api request",
+    ("view", "method"),
+    buckets=QUERY_BUCKETS,
+)
+
+DB_POOL_CONNECTIONS = CallbackGauge(
+    "chat_db_pool_connections",
+    "Database connection pool size and connections by state",
+    ("database", "state"),
+    callback=pool_stats,
+)
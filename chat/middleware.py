@@ -0,0 +1,59 @@
+from urllib.parse import parse_qs
+
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from django.utils.functional import SimpleLazyObject
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+
+
+TOKEN_SUBPROTOCOL_PREFIX = "jwt."
+
+
+'''
+Finds the access token of a websocket connection in the token
+query parameter or in a "jwt.<token>" subprotocol, returns the
+token and the subprotocol it came in
+'''
+def get_raw_token(scope):
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if query.get("token"):
+        return query["token"][0], None
+    for subprotocol in scope.get("subprotocols", []):
+        if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX) :], subprotocol
+    return None, None
+
+
+'''
+Validates the token with the SIMPLE_JWT settings and returns
+a TokenUser built from its claims, no database query is made
+'''
+def get_token_user(raw_token):
+    authentication = JWTStatelessUserAuthentication()
+    try:
+        validated_token = authentication.get_validated_token(raw_token)
+        return authentication.get_user(validated_token)
+    except AuthenticationFailed:
+        return AnonymousUser()
+
+
+'''
+Websocket middleware that authenticates connections with the
+same access tokens as the REST api. scope["user"] is resolved
+the first time it is used, scope["token_subprotocol"] holds the
+subprotocol the token came in so the consumer can accept it
+'''
+class JWTAuthMiddleware(BaseMiddleware):
+    async def __call__(self, scope, receive, send):
+        raw_token, subprotocol = get_raw_token(scope)
+        scope = dict(scope, token_subprotocol=subprotocol)
+        if raw_token is None:
+            scope["user"] = AnonymousUser()
+        else:
+            scope["user"] = SimpleLazyObject(lambda: get_token_user(raw_token))
+        return await super().__call__(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    return JWTAuthMiddleware(inner)
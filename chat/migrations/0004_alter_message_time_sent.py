@@ -0,0 +1,20 @@
+# Generated by Django 3.2.15 on 2026-10-18 20:17
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0003_room_participants"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="message",
+            name="time_sent",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.15 on 2026-10-18 20:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0004_alter_message_time_sent"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["room", "time_sent", "id"], name="chat_message_room_time"
+            ),
+        ),
+    ]
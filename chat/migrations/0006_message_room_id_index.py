@@ -0,0 +1,16 @@
+# Generated by Django 3.2.15 on 2026-10-18 20:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0005_message_room_time_index"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["room", "id"], name="chat_message_room_id"),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.2.15 on 2026-10-18 20:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0006_message_room_id_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClosedRoom",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("room_id", models.BigIntegerField(unique=True)),
+                ("closed_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="MessageArchive",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("room_id", models.BigIntegerField()),
+                ("user_id", models.IntegerField()),
+                ("text", models.TextField()),
+                ("time_sent", models.DateTimeField()),
+                (
+                    "archived_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="room",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                to="chat.room",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="messagearchive",
+            index=models.Index(fields=["room_id", "id"], name="chat_archive_room_id"),
+        ),
+    ]
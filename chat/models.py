@@ -1,20 +1,121 @@
 import string
-import random
+import secrets
 
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 
+CODE_ALPHABET = string.ascii_uppercase
+CODE_LENGTH = 6
+
+
+'''
+Hands out room codes without asking the database. Codes are
+the only thing that lets someone join a room, so they are
+drawn from a CSPRNG and can not be guessed from other codes.
+A code that is already taken is caught by the unique index
+'''
+class RoomCodeAllocator:
+    def next_code(self):
+        return "".join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+
+
+room_codes = RoomCodeAllocator()
+
+
 '''
 Generates a 6 chars code in uppercase  
 '''
 def generate_room_code():
-    while True:
-        code = "".join(random.choices(string.ascii_uppercase, k=6))
-        if not Room.objects.filter(code=code).exists():
-            return code
+    return room_codes.next_code()
+
+
+'''
+Tells if the database can return columns from an UPDATE
+'''
+def can_return_from_update(connection):
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+class RoomQuerySet(models.QuerySet):
+    '''
+    Takes a seat in the room with the given code with one
+    conditional UPDATE, so concurrent joins can never go past
+    max_participants. Returns the updated room, or None if the
+    room does not exist or is full
+    '''
+    def join(self, code):
+        self._for_write = True
+        connection = connections[self.db]
+        if not can_return_from_update(connection):
+            if self.filter(code=code, participants__lt=F("max_participants")).update(
+                participants=F("participants") + 1
+            ):
+                return self.get(code=code)
+            return None
+
+        participants = connection.ops.quote_name("participants")
+        max_participants = connection.ops.quote_name("max_participants")
+        return self.update_returning(
+            connection,
+            f"{participants} = {participants} + 1",
+            f"{connection.ops.quote_name('code')} = %s "
+            f"AND {participants} < {max_participants}",
+            [code],
+        )
+
+    '''
+    Gives back the seat of a user that is not the host of the
+    room, never going below zero. Returns the updated room, or
+    None if there is no such room or the user is its host
+    '''
+    def leave(self, code, user_id):
+        self._for_write = True
+        connection = connections[self.db]
+        if not can_return_from_update(connection):
+            if (
+                self.filter(code=code)
+                .exclude(host_id=user_id)
+                .update(participants=Greatest(F("participants") - 1, 0))
+            ):
+                return self.get(code=code)
+            return None
+
+        participants = connection.ops.quote_name("participants")
+        return self.update_returning(
+            connection,
+            f"{participants} = CASE WHEN {participants} > 0 "
+            f"THEN {participants} - 1 ELSE 0 END",
+            f"{connection.ops.quote_name('code')} = %s "
+            f"AND {connection.ops.quote_name('host_id')} <> %s",
+            [code, user_id],
+        )
+
+    def update_returning(self, connection, assignment, condition, params):
+        opts = self.model._meta
+        field_names = [field.attname for field in opts.concrete_fields]
+        columns = ", ".join(
+            connection.ops.quote_name(field.column) for field in opts.concrete_fields
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {connection.ops.quote_name(opts.db_table)} "
+                f"SET {assignment} WHERE {condition} RETURNING {columns}",
+                params,
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return self.model.from_db(self.db, field_names, row)
 
 
 class Room(models.Model):
@@ -25,23 +126,83 @@ class Room(models.Model):
     code = models.CharField(max_length=6, unique=True, default=generate_room_code)
     participants = models.IntegerField(validators=[MinValueValidator(0)], default=0)
 
+    objects = RoomQuerySet.as_manager()
+
+    CODE_ATTEMPTS = 5
+
     def validate_participants(self):
         if self.participants > self.max_participants:
             raise ValidationError("Room is full !")
 
+    '''
+    Codes are not checked before the insert, if one is
+    already taken the insert is retried with a new code
+    '''
     def save(self, *args, **kwargs) -> None:
         self.validate_participants()
-        return super().save(*args, **kwargs)
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        for attempt in range(self.CODE_ATTEMPTS):
+            try:
+                with transaction.atomic(using=kwargs.get("using")):
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                if attempt == self.CODE_ATTEMPTS - 1:
+                    raise
+                self.code = generate_room_code()
 
     def __str__(self) -> str:
         return self.code
 
 
+'''
+Rooms closed by their host. Their messages are not deleted
+with the room, the retention job archives them later
+'''
+class ClosedRoom(models.Model):
+    room_id = models.BigIntegerField(unique=True)
+    closed_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self) -> str:
+        return str(self.room_id)
+
+
 class Message(models.Model):
-    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    # Closing a room must not delete its messages in the same
+    # request, the retention job cleans them up in chunks
+    room = models.ForeignKey(Room, on_delete=models.DO_NOTHING, db_constraint=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     text = models.TextField()
-    time_sent = models.DateTimeField(auto_now_add=True)
+    time_sent = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["room", "time_sent", "id"], name="chat_message_room_time"
+            ),
+            models.Index(fields=["room", "id"], name="chat_message_room_id"),
+        ]
+
+    def __str__(self) -> str:
+        return self.text
+
+
+'''
+Messages moved out of the message table by the retention job
+'''
+class MessageArchive(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    room_id = models.BigIntegerField()
+    user_id = models.IntegerField()
+    text = models.TextField()
+    time_sent = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["room_id", "id"], name="chat_archive_room_id"),
+        ]
 
     def __str__(self) -> str:
         return self.text
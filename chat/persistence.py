@@ -0,0 +1,279 @@
+import time
+import uuid
+import atexit
+import random
+import asyncio
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from channels.db import database_sync_to_async
+
+from .db.routers import mark_primary
+from .models import Message
+from .metrics import MESSAGES_WRITTEN, MESSAGE_WRITE_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+# 2023-01-01 00:00:00 UTC in milliseconds
+ID_EPOCH_MS = 1672531200000
+
+
+'''
+Generates time ordered message ids before the row is written.
+An id is made of 40 bits of milliseconds, 5 bits of node id and
+8 bits of sequence, so it stays below 2^53 and is safe for
+javascript clients
+'''
+class MessageIdGenerator:
+    NODE_BITS = 5
+    SEQUENCE_BITS = 8
+
+    def __init__(self, node_id):
+        if not 0 <= node_id < 1 << self.NODE_BITS:
+            raise ImproperlyConfigured(f"Node id {node_id} is not in 0-31")
+        self.node_id = node_id
+        self.last_ms = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            now_ms = int(time.time() * 1000)
+            if now_ms > self.last_ms:
+                self.sequence = 0
+            else:
+                # Same millisecond or the clock went back,
+                # keep counting from the last used millisecond
+                now_ms = self.last_ms
+                self.sequence = (self.sequence + 1) % (1 << self.SEQUENCE_BITS)
+                if self.sequence == 0:
+                    now_ms += 1
+            self.last_ms = now_ms
+
+        return (
+            ((now_ms - ID_EPOCH_MS) << (self.NODE_BITS + self.SEQUENCE_BITS))
+            | (self.node_id << self.SEQUENCE_BITS)
+            | self.sequence
+        )
+
+
+'''
+Leases one of the 32 node ids from the shared cache, so no two
+processes generate message ids with the same node id. The lease
+lasts ttl seconds and is renewed when a third of it is gone,
+a process that lost its lease takes a free id again
+'''
+class NodeIdLease:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.node_id = None
+        self.renewed_at = 0
+
+    def key(self, node_id):
+        return f"chat:node:{node_id}"
+
+    def stale(self):
+        if self.node_id is None:
+            return True
+        return time.monotonic() - self.renewed_at >= self.ttl / 3
+
+    def current(self):
+        now = time.monotonic()
+        if self.node_id is not None:
+            if not self.stale():
+                return self.node_id
+            if cache.get(self.key(self.node_id)) == self.token:
+                cache.set(self.key(self.node_id), self.token, self.ttl)
+                self.renewed_at = now
+                return self.node_id
+
+        node_ids = 1 << MessageIdGenerator.NODE_BITS
+        start = random.randrange(node_ids)
+        for offset in range(node_ids):
+            node_id = (start + offset) % node_ids
+            if cache.add(self.key(node_id), self.token, self.ttl):
+                self.node_id, self.renewed_at = node_id, now
+                return node_id
+        raise ImproperlyConfigured("All node ids are taken, set CHAT_NODE_ID")
+
+
+'''
+Per process write-behind buffer for chat messages. Messages get
+their id when queued and are written with bulk_create once the
+buffer reaches max_size or flush_interval seconds have passed.
+Ids embed the node id, CHAT_NODE_ID or one leased from the
+shared cache. Queued messages were already broadcast, a batch
+that fails to write is queued again and retried with exponential
+backoff up to max_retry_delay for as long as it takes. The buffer
+holds at most limit messages, more are refused while it is full
+'''
+class MessageBufferFull(Exception):
+    pass
+
+
+class MessageWriteBuffer:
+    def __init__(
+        self,
+        max_size=100,
+        flush_interval=0.05,
+        node_id=None,
+        limit=10000,
+        retry_delay=0.5,
+        max_retry_delay=30,
+    ):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.limit = limit
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lease = None if node_id is not None else NodeIdLease()
+        self.ids = MessageIdGenerator(0 if node_id is None else node_id)
+        self.pending = []
+        self.writing = []
+        self.failures = 0
+        self.timer = None
+        self.tasks = set()
+
+    '''
+    Renews the node id lease in a thread when it is due, so add
+    does not wait on the cache on the event loop
+    '''
+    async def renew_node_id(self):
+        if self.lease is not None and self.lease.stale():
+            self.ids.node_id = await database_sync_to_async(self.lease.current)()
+
+    def full(self):
+        return len(self.pending) + len(self.writing) >= self.limit
+
+    def add(self, room_id, user_id, text):
+        if self.full():
+            raise MessageBufferFull()
+        if self.lease is not None and self.lease.stale():
+            self.ids.node_id = self.lease.current()
+        message = Message(
+            id=self.ids.next_id(), room_id=room_id, user_id=user_id, text=text
+        )
+        self.pending.append(message)
+
+        # While a failed batch waits for its retry, new
+        # messages wait with it
+        if self.failures:
+            return message
+        if len(self.pending) >= self.max_size:
+            self.schedule_flush(0)
+        elif self.timer is None:
+            self.schedule_flush(self.flush_interval)
+
+        return message
+
+    '''
+    Returns the queued messages of a room that are
+    not written to the database yet
+    '''
+    def pending_for_room(self, room_id):
+        return [
+            message
+            for message in self.writing + self.pending
+            if str(message.room_id) == str(room_id)
+        ]
+
+    def schedule_flush(self, delay):
+        loop = asyncio.get_running_loop()
+        if delay:
+            self.timer = loop.call_later(delay, self.start_flush)
+        else:
+            self.start_flush()
+
+    def start_flush(self):
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        self.writing = self.writing + batch
+        try:
+            await database_sync_to_async(self.write)(batch)
+            self.failures = 0
+        except Exception:
+            self.failures += 1
+            logger.exception(
+                "Could not write %s messages, %s failed writes in a row",
+                len(batch),
+                self.failures,
+            )
+            # The messages were already broadcast, they are
+            # kept in order in front of the newer ones
+            self.pending = batch + self.pending
+            self.schedule_flush(
+                min(self.retry_delay * 2 ** (self.failures - 1), self.max_retry_delay)
+            )
+        finally:
+            written = set(map(id, batch))
+            self.writing = [m for m in self.writing if id(m) not in written]
+
+        # Messages queued while the batch waited for its retry
+        if self.pending and not self.failures and self.timer is None:
+            self.schedule_flush(self.flush_interval)
+
+    '''
+    Flushes whatever is left without an event loop,
+    registered to run when the process exits
+    '''
+    def flush_sync(self):
+        batch, self.pending = self.pending, []
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        started = time.perf_counter()
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+        except IntegrityError:
+            # One bad row (deleted user, duplicate id) must not
+            # take the whole batch down with it
+            for message in batch:
+                self.write_one(message)
+        # Senders read their messages back from the primary
+        mark_primary({message.user_id for message in batch})
+        MESSAGE_WRITE_SECONDS.observe(time.perf_counter() - started)
+        MESSAGES_WRITTEN.inc(len(batch))
+
+    '''
+    Writes one message of a batch that failed. The id was
+    already sent to clients, so a row that can not be stored
+    with it is dropped and logged rather than renumbered
+    '''
+    def write_one(self, message):
+        try:
+            with transaction.atomic():
+                message.save(force_insert=True)
+        except IntegrityError:
+            logger.exception(
+                "Dropped message %s for room %s", message.id, message.room_id
+            )
+
+
+message_buffer = MessageWriteBuffer(
+    max_size=getattr(settings, "CHAT_MESSAGE_BUFFER_SIZE", 100),
+    flush_interval=getattr(settings, "CHAT_MESSAGE_FLUSH_INTERVAL", 0.05),
+    node_id=getattr(settings, "CHAT_NODE_ID", None),
+    limit=getattr(settings, "CHAT_MESSAGE_BUFFER_LIMIT", 10000),
+    retry_delay=getattr(settings, "CHAT_MESSAGE_RETRY_DELAY", 0.5),
+    max_retry_delay=getattr(settings, "CHAT_MESSAGE_RETRY_MAX_DELAY", 30),
+)
+
+atexit.register(message_buffer.flush_sync)
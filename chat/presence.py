@@ -0,0 +1,131 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from channels.db import database_sync_to_async
+
+from .rooms import release_seats
+
+
+'''
+Tracks who is connected to each room of this process.
+Connections are only removed when their socket closes, so a
+reader that never sends a frame stays present. A user whose
+last connection to a room dropped without a clean close gets
+grace seconds to reconnect, after that the seat they took
+with join-room, if any, is given back. Seats are released in
+batches every flush_interval seconds
+'''
+class PresenceStore:
+    def __init__(self, grace=10, flush_interval=1):
+        self.grace = grace
+        self.flush_interval = flush_interval
+        # room code -> user id (channel name for anonymous
+        # connections) -> channels of that user in the room
+        self.rooms = {}
+        # channel -> (room code, member, user id)
+        self.channels = {}
+        # (room code, user id) -> release at, oldest first
+        self.departed = OrderedDict()
+        self.releases = defaultdict(list)
+        self.lock = threading.Lock()
+        self.timer = None
+        self.tasks = set()
+
+    def connect(self, code, channel, user_id=None):
+        member = channel if user_id is None else user_id
+        with self.lock:
+            self.channels[channel] = (code, member, user_id)
+            self.rooms.setdefault(code, {}).setdefault(member, set()).add(channel)
+            if user_id is not None:
+                self.departed.pop((code, user_id), None)
+
+    '''
+    Removes a connection, abandoned tells that it did not
+    close cleanly and its seat should be released
+    '''
+    def disconnect(self, channel, abandoned=False):
+        with self.lock:
+            departed = self.remove(channel, abandoned, time.monotonic())
+        if departed:
+            self.schedule()
+
+    def remove(self, channel, abandoned, now):
+        entry = self.channels.pop(channel, None)
+        if entry is None:
+            return False
+        code, member, user_id = entry
+        members = self.rooms[code]
+        members[member].discard(channel)
+        if members[member]:
+            return False
+        del members[member]
+        if not members:
+            del self.rooms[code]
+        if abandoned and user_id is not None:
+            self.departed[(code, user_id)] = now + self.grace
+            return True
+        return False
+
+    '''
+    Number of users and anonymous connections in the room
+    '''
+    def count(self, code):
+        return len(self.rooms.get(code, ()))
+
+    '''
+    Ids of the signed in users connected to the room
+    '''
+    def members(self, code):
+        return [member for member in self.rooms.get(code, ()) if type(member) is int]
+
+    '''
+    Returns the users whose grace ran out by room code
+    '''
+    def sweep(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            while self.departed:
+                (code, user_id), release_at = next(iter(self.departed.items()))
+                if release_at > now:
+                    break
+                del self.departed[(code, user_id)]
+                self.releases[code].append(user_id)
+
+            releases, self.releases = dict(self.releases), defaultdict(list)
+        return releases
+
+    def schedule(self):
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.flush_interval, self.tick)
+
+    def tick(self):
+        self.timer = None
+        releases = self.sweep()
+        if releases:
+            task = asyncio.get_running_loop().create_task(
+                database_sync_to_async(release_seats)(releases)
+            )
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        if self.departed:
+            self.schedule()
+
+    def clear(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        with self.lock:
+            self.rooms.clear()
+            self.channels.clear()
+            self.departed.clear()
+            self.releases.clear()
+
+
+presence = PresenceStore(
+    grace=getattr(settings, "CHAT_PRESENCE_GRACE", 10),
+    flush_interval=getattr(settings, "CHAT_PRESENCE_FLUSH_INTERVAL", 1),
+)
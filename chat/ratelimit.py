@@ -0,0 +1,81 @@
+import time
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+'''
+Token bucket allowing rate actions per second on average
+and bursts of up to burst actions
+'''
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now=None):
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    '''
+    Seconds until the next action is allowed
+    '''
+    def delay(self, now=None):
+        self.refill(time.monotonic() if now is None else now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+'''
+One token bucket per key, for the busiest max_keys keys.
+A bucket that was evicted comes back full, which only ever
+lets an idle key through
+'''
+class BucketMap:
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket
+
+    def consume(self, key, now=None):
+        bucket = self.get(key)
+        with self.lock:
+            return bucket.consume(now)
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+def connection_buckets():
+    return (
+        TokenBucket(*getattr(settings, "CHAT_RATE_CONNECTION_EVENTS", (10, 20))),
+        TokenBucket(*getattr(settings, "CHAT_RATE_CONNECTION_MESSAGES", (5, 20))),
+    )
+
+
+room_events = BucketMap(*getattr(settings, "CHAT_RATE_ROOM_EVENTS", (50, 100)))
+
+room_messages = BucketMap(*getattr(settings, "CHAT_RATE_ROOM_MESSAGES", (30, 60)))
@@ -0,0 +1,131 @@
+import pickle
+
+import redis
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+
+'''
+Cache backend on Redis for django 3.2, which has none. Every
+process of every node sees the same entries, so invalidations
+and markers set by one worker are seen by the others. Integers
+are stored as they are so incr works, anything else is pickled
+'''
+class RedisCache(BaseCache):
+    def __init__(self, server, params):
+        super().__init__(params)
+        self.server = server
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.server)
+        return self._client
+
+    def dumps(self, value):
+        if type(value) is int:
+            return value
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            return pickle.loads(value)
+
+    def expiry(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return None if timeout is None else max(0, int(timeout))
+
+    def key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        expiry = self.expiry(timeout)
+        if expiry == 0:
+            return False
+        return bool(
+            self.client.set(
+                self.key(key, version), self.dumps(value), ex=expiry, nx=True
+            )
+        )
+
+    def get(self, key, default=None, version=None):
+        value = self.client.get(self.key(key, version))
+        return default if value is None else self.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        expiry = self.expiry(timeout)
+        if expiry == 0:
+            self.delete(key, version)
+            return
+        self.client.set(self.key(key, version), self.dumps(value), ex=expiry)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        expiry = self.expiry(timeout)
+        if expiry is None:
+            return bool(self.client.persist(self.key(key, version)))
+        return bool(self.client.expire(self.key(key, version), expiry))
+
+    def delete(self, key, version=None):
+        return bool(self.client.delete(self.key(key, version)))
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self.key(key, version) for key in keys])
+        return {
+            key: self.loads(value)
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expiry = self.expiry(timeout)
+        with self.client.pipeline() as pipeline:
+            for key, value in data.items():
+                if expiry == 0:
+                    pipeline.delete(self.key(key, version))
+                else:
+                    pipeline.set(self.key(key, version), self.dumps(value), ex=expiry)
+            pipeline.execute()
+        return []
+
+    def delete_many(self, keys, version=None):
+        keys = [self.key(key, version) for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def has_key(self, key, version=None):
+        return bool(self.client.exists(self.key(key, version)))
+
+    def incr(self, key, delta=1, version=None):
+        key = self.key(key, version)
+        if not self.client.exists(key):
+            raise ValueError(f"Key '{key}' not found")
+        return self.client.incr(key, delta)
+
+    '''
+    Deletes the keys of this cache only, the database may be
+    shared with the channel layer
+    '''
+    def clear(self):
+        prefix = "".join(
+            f"\\{char}" if char in "*?[]\\" else char for char in self.key_prefix
+        )
+        pattern = f"{prefix}:*"
+        keys = []
+        for key in self.client.scan_iter(match=pattern, count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                self.client.delete(*keys)
+                keys = []
+        if keys:
+            self.client.delete(*keys)
+
+    def close(self, **kwargs):
+        pass
@@ -0,0 +1,100 @@
+from collections import deque
+
+from django.conf import settings
+
+from .codecs import encode_frames
+from .db.routers import use_primary
+from .models import Message
+from .persistence import message_buffer
+
+
+'''
+Keeps the encoded frames of the last size messages broadcast
+to each room that has members on this process. A room starts
+recording when its first member connects and is dropped with
+its last one, so what is buffered has no gaps and a client can
+be caught up from memory whenever the message it last saw is
+still buffered
+'''
+class ReplayBuffer:
+    def __init__(self, size=200):
+        self.size = size
+        self.rooms = {}
+        self.members = {}
+
+    def join(self, code):
+        self.members[code] = self.members.get(code, 0) + 1
+        if code not in self.rooms:
+            self.rooms[code] = (deque(), set())
+
+    def leave(self, code):
+        self.members[code] = self.members.get(code, 1) - 1
+        if self.members[code] <= 0:
+            del self.members[code]
+            self.rooms.pop(code, None)
+
+    '''
+    Records a broadcast message, every member of the room
+    hands in the same message so repeats are skipped
+    '''
+    def add(self, code, message_id, frames):
+        room = self.rooms.get(code)
+        if room is None:
+            return
+        messages, ids = room
+        if message_id in ids:
+            return
+        messages.append((message_id, frames))
+        ids.add(message_id)
+        if len(messages) > self.size:
+            ids.discard(messages.popleft()[0])
+
+    '''
+    Returns the (id, frames) of the messages sent after the
+    given id, or None when the buffer can not tell
+    '''
+    def since(self, code, last_seen_id):
+        room = self.rooms.get(code)
+        if room is None or not room[0] or room[0][0][0] > last_seen_id:
+            return None
+        return [message for message in room[0] if message[0] > last_seen_id]
+
+    def clear(self):
+        self.rooms.clear()
+        self.members.clear()
+
+
+def message_data(message):
+    return {
+        "user": message.user_id,
+        "roomId": message.room_id,
+        "text": message.text,
+        "id": message.id,
+    }
+
+
+'''
+Loads up to limit messages of a room sent after the given
+id, including the ones still waiting in the write buffer,
+encoded as they were broadcast to the room with that code.
+Reads the primary, replicas may lag behind the last flush
+'''
+def load_missed_messages(room_id, code, last_seen_id, limit):
+    with use_primary():
+        messages = {
+            message.id: message
+            for message in Message.objects.filter(
+                room_id=room_id, id__gt=last_seen_id
+            ).order_by("id")[:limit]
+        }
+    for message in message_buffer.pending_for_room(room_id):
+        if message.id > last_seen_id:
+            messages.setdefault(message.id, message)
+
+    return [
+        (message_id, encode_frames({"room": code, "message": message_data(message)}))
+        for message_id, message in sorted(messages.items())[:limit]
+    ]
+
+
+replay_buffer = ReplayBuffer(size=getattr(settings, "CHAT_REPLAY_SIZE", 200))
@@ -0,0 +1,79 @@
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ClosedRoom, Message, MessageArchive
+
+
+ARCHIVED_FIELDS = ("id", "room_id", "user_id", "text", "time_sent")
+
+
+'''
+Moves the oldest chunk_size messages of the queryset to the
+archive table, or deletes them when archive is False, in one
+transaction. Returns how many messages were moved
+'''
+def archive_chunk(queryset, chunk_size, archive=True):
+    with transaction.atomic():
+        rows = list(queryset.order_by("id").values(*ARCHIVED_FIELDS)[:chunk_size])
+        if not rows:
+            return 0
+        if archive:
+            MessageArchive.objects.bulk_create(
+                [MessageArchive(**row) for row in rows], ignore_conflicts=True
+            )
+        Message.objects.filter(id__in=[row["id"] for row in rows]).delete()
+    return len(rows)
+
+
+'''
+Retention job. Cleans up the messages of rooms closed more than
+closed_delay seconds ago, which leaves time for write buffers to
+drain, then the messages older than retention_days when it is
+set. Work is done in chunks of chunk_size messages with pause
+seconds between them, and stops after max_chunks chunks
+'''
+def run_retention(
+    chunk_size=1000,
+    retention_days=None,
+    archive=True,
+    closed_delay=60,
+    pause=0,
+    max_chunks=None,
+):
+    totals = {"closed_rooms": 0, "closed_room_messages": 0, "expired_messages": 0}
+    chunks = 0
+
+    def chunk_allowed():
+        return max_chunks is None or chunks < max_chunks
+
+    closed_before = timezone.now() - timedelta(seconds=closed_delay)
+    for closed_room in ClosedRoom.objects.filter(closed_at__lte=closed_before):
+        if not chunk_allowed():
+            break
+        messages = Message.objects.filter(room_id=closed_room.room_id)
+        while chunk_allowed():
+            moved = archive_chunk(messages, chunk_size, archive)
+            if not moved:
+                closed_room.delete()
+                totals["closed_rooms"] += 1
+                break
+            chunks += 1
+            totals["closed_room_messages"] += moved
+            time.sleep(pause)
+
+    if retention_days is not None:
+        cutoff = timezone.now() - timedelta(days=retention_days)
+        messages = Message.objects.filter(time_sent__lt=cutoff)
+        while chunk_allowed():
+            moved = archive_chunk(messages, chunk_size, archive)
+            if not moved:
+                break
+            chunks += 1
+            totals["expired_messages"] += moved
+            time.sleep(pause)
+
+    return totals
+
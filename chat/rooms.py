@@ -0,0 +1,227 @@
+from collections import defaultdict
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.functions import Greatest
+from channels.db import database_sync_to_async
+
+from .db.routers import use_primary
+from .lifecycle import publish_room_event, room_state
+from .models import Room
+
+
+MISSING = object()
+
+
+def room_cache_key(code):
+    return f"chat:room:{code}"
+
+
+def seat_key(code, user_id):
+    return f"chat:seat:{code}:{user_id}"
+
+
+def left_key(code, user_id):
+    return f"chat:left:{code}:{user_id}"
+
+
+def left_ttl():
+    return getattr(settings, "CHAT_SEAT_LEFT_TTL", 86400)
+
+
+'''
+Returns the cached room with the given code, None for a
+cached unknown code, or MISSING if nothing is cached
+'''
+def get_cached_room(code):
+    if not getattr(settings, "CHAT_ROOM_CACHE_TTL", 0):
+        return MISSING
+    return cache.get(room_cache_key(code), MISSING)
+
+
+'''
+Rows that go into the shared cache are read from the primary,
+a lagging replica would serve its stale row to every worker
+'''
+def load_room(code):
+    ttl = getattr(settings, "CHAT_ROOM_CACHE_TTL", 0)
+    with use_primary() if ttl else nullcontext():
+        try:
+            room = Room.objects.get(code=code)
+        except Room.DoesNotExist:
+            room = None
+
+    if ttl:
+        cache.set(room_cache_key(code), room, ttl)
+    return room
+
+
+'''
+Returns the room with the given code, or None, in a single
+query. With CHAT_ROOM_CACHE_TTL set, rooms and unknown codes
+are cached for that many seconds
+'''
+def get_room(code):
+    room = get_cached_room(code)
+    if room is not MISSING:
+        return room
+    return load_room(code)
+
+
+'''
+Async get_room. The cache may be Redis with a blocking client,
+so the lookup and a miss run together in one database thread
+'''
+async def aget_room(code):
+    return await database_sync_to_async(get_room)(code)
+
+
+'''
+Returns the cached rooms among the given codes, unknown
+codes that are cached map to None
+'''
+def get_cached_rooms(codes):
+    if not getattr(settings, "CHAT_ROOM_CACHE_TTL", 0):
+        return {}
+    cached = cache.get_many([room_cache_key(code) for code in codes])
+    return {
+        code: cached[room_cache_key(code)]
+        for code in codes
+        if room_cache_key(code) in cached
+    }
+
+
+def load_rooms(codes):
+    ttl = getattr(settings, "CHAT_ROOM_CACHE_TTL", 0)
+    rooms = dict.fromkeys(codes)
+    with use_primary() if ttl else nullcontext():
+        rooms.update((room.code, room) for room in Room.objects.filter(code__in=codes))
+
+    if ttl:
+        cache.set_many(
+            {room_cache_key(code): room for code, room in rooms.items()}, ttl
+        )
+    return rooms
+
+
+'''
+Returns a dict of the given codes to their room or None,
+with one cache lookup and one query for the codes that
+are not cached
+'''
+def get_rooms(codes):
+    rooms = get_cached_rooms(codes)
+    missing = [code for code in codes if code not in rooms]
+    if missing:
+        rooms.update(load_rooms(missing))
+    return {code: rooms[code] for code in codes}
+
+
+async def aget_rooms(codes):
+    return await database_sync_to_async(get_rooms)(codes)
+
+
+'''
+Drops the cached room, called whenever a room row changes
+'''
+def invalidate_room(code):
+    if getattr(settings, "CHAT_ROOM_CACHE_TTL", 0):
+        cache.delete(room_cache_key(code))
+
+
+'''
+Takes a seat for the user in the room with the given code.
+Returns the room, or None with a flag telling if the room
+exists at all. Seats taken are recorded in the shared cache,
+a user holds at most one seat per room
+'''
+def join_room(code, user_id):
+    key = seat_key(code, user_id)
+    if not cache.add(key, True, getattr(settings, "CHAT_SEAT_TTL", None)):
+        room = get_room(code)
+        return room, room is not None
+
+    room = Room.objects.join(code)
+    if room is not None:
+        cache.delete(left_key(code, user_id))
+        invalidate_room(code)
+        publish_room_event(code, room_state("participants", room))
+        return room, True
+    cache.delete(key)
+    return None, get_room(code) is not None
+
+
+'''
+Leaves the room with the given code, closing it when the
+user is the host. Returns False if there is no such room.
+A seat whose record is gone, evicted from the cache or taken
+before seats were recorded, is given back once: leaving marks
+the user as left for CHAT_SEAT_LEFT_TTL seconds
+'''
+def leave_room(code, user_id):
+    # A participant gives back their seat with one UPDATE, if
+    # presence did not already. Only the host falls through
+    # to closing the room
+    had_seat = cache.delete(seat_key(code, user_id))
+    first_leave = cache.add(left_key(code, user_id), True, left_ttl())
+    if had_seat or first_leave:
+        room = Room.objects.leave(code, user_id)
+        if room is not None:
+            invalidate_room(code)
+            publish_room_event(code, room_state("participants", room))
+            return True
+    room = Room.objects.filter(code=code, host_id=user_id).first()
+    if room is None:
+        return get_room(code) is not None
+    close_room(room)
+    return True
+
+
+'''
+Gives back the seats users left without leave-room, by room
+code. Seats that were never taken with join-room, or already
+given back, are skipped. Rooms releasing the same number of
+seats share one UPDATE
+'''
+def release_seats(departures):
+    releases = {}
+    left = []
+    for code, user_ids in departures.items():
+        released = [
+            user_id for user_id in user_ids if cache.delete(seat_key(code, user_id))
+        ]
+        if released:
+            releases[code] = len(released)
+            left += [left_key(code, user_id) for user_id in released]
+    # A later leave-room of these users must not give back another seat
+    cache.set_many(dict.fromkeys(left, True), left_ttl())
+
+    codes_by_seats = defaultdict(list)
+    for code, seats in releases.items():
+        codes_by_seats[seats].append(code)
+
+    for seats, codes in codes_by_seats.items():
+        Room.objects.filter(code__in=codes).update(
+            participants=Greatest(F("participants") - seats, 0)
+        )
+    for code in releases:
+        invalidate_room(code)
+
+    fields = ("code", "participants", "max_participants")
+    with use_primary():
+        rooms = list(Room.objects.filter(code__in=list(releases)).only(*fields))
+    for room in rooms:
+        publish_room_event(room.code, room_state("participants", room))
+    return releases
+
+
+'''
+Deletes a room, its messages are handed over to the retention
+job by the post_delete handler, so closing a big room costs the
+same as a small one
+'''
+def close_room(room):
+    room.delete()
+    publish_room_event(room.code, {"type": "closed"})
@@ -3,5 +3,7 @@ from django.urls import path
 from . import consumers
 
 websocket_urlpatterns = [
+    path("ws/chat/", consumers.MultiplexChatConsumer.as_asgi()),
+    path("ws/lobby/", consumers.LobbyConsumer.as_asgi()),
     path("ws/chat/<str:room_name>/", consumers.ChatConsumer.as_asgi()),
 ]
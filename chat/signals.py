@@ -0,0 +1,22 @@
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
+
+from .models import ClosedRoom, Room
+from .rooms import invalidate_room
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def room_changed(sender, instance, **kwargs):
+    invalidate_room(instance.code)
+
+
+'''
+Hands the messages of a deleted room over to the retention
+job, whether it was closed by its host or deleted elsewhere
+'''
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, using, **kwargs):
+    ClosedRoom.objects.using(using).bulk_create(
+        [ClosedRoom(room_id=instance.id)], ignore_conflicts=True
+    )
@@ -0,0 +1,164 @@
+import os
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from django.urls import reverse
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from chat.models import Room
+from chat.tests.factories import UserFactory, MessageFactory
+from .utils import percentile, record, scaled
+
+
+# Most queries one request of each endpoint may run,
+# transaction control statements are not counted
+QUERY_BUDGETS = {
+    "create-room": 2,
+    "join-room": 1,
+    "get-room-details": 1,
+    "get-messages": 1,
+    "leave-room": 1,
+    "close-room": 4,
+}
+
+TRANSACTION_STATEMENTS = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+def count_queries(captures):
+    return sum(
+        not query["sql"].startswith(TRANSACTION_STATEMENTS)
+        for queries in captures
+        for query in queries.captured_queries
+    )
+
+
+def bearer(user):
+    access_token = RefreshToken.for_user(user).access_token
+    return {"HTTP_AUTHORIZATION": f"Bearer {access_token}"}
+
+
+'''
+Runs create-room, join-room, get-room-details, get-messages and
+leave-room for one host and one participant, then closes the room.
+Returns the latency and query count of every request
+'''
+def run_flow(host, participant, history=20):
+    client = APIClient()
+    host_auth, participant_auth = bearer(host), bearer(participant)
+    results = []
+
+    def call(name, method, url, data, auth):
+        started = time.perf_counter()
+        # Reads may go to a replica, queries on every database count
+        with ExitStack() as stack:
+            captures = [
+                stack.enter_context(CaptureQueriesContext(alias_connection))
+                for alias_connection in connections.all()
+            ]
+            response = getattr(client, method)(url, data, **auth)
+        results.append((name, time.perf_counter() - started, count_queries(captures)))
+        assert response.status_code < 300, (name, response.data)
+        return response
+
+    room = call(
+        "create-room",
+        "post",
+        reverse("chat:create-room"),
+        {"max_participants": 5},
+        host_auth,
+    ).data
+    MessageFactory.create_batch(
+        size=history, room=Room.objects.get(id=room["id"]), user=host
+    )
+
+    code = {"code": room["code"]}
+    call("join-room", "put", reverse("chat:join-room"), code, participant_auth)
+    call(
+        "get-room-details",
+        "get",
+        reverse("chat:get-room-details"),
+        code,
+        participant_auth,
+    )
+    call(
+        "get-messages",
+        "get",
+        reverse("chat:get-messages"),
+        {"roomId": room["id"]},
+        participant_auth,
+    )
+    call("leave-room", "put", reverse("chat:leave-room"), code, participant_auth)
+    call("close-room", "put", reverse("chat:leave-room"), code, host_auth)
+    return results
+
+
+def summarize(results, seconds):
+    by_endpoint = defaultdict(list)
+    for name, latency, queries in results:
+        by_endpoint[name].append((latency, queries))
+
+    endpoints = {}
+    for name, samples in by_endpoint.items():
+        latencies = [latency for latency, _ in samples]
+        endpoints[name] = {
+            "requests": len(samples),
+            "requests_per_sec": len(samples) / sum(latencies),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_queries": max(queries for _, queries in samples),
+        }
+
+    return {"requests_per_sec": len(results) / seconds, "endpoints": endpoints}
+
+
+@pytest.fixture(autouse=True)
+def fast_password_hasher(settings):
+    settings.PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+
+
+# Queries are captured on every database, replicas included
+@pytest.mark.django_db(transaction=True, databases="__all__")
+def test_api_query_budgets():
+    users = UserFactory.create_batch(size=2)
+
+    results = run_flow(*users)
+
+    for name, _, queries in results:
+        assert queries <= QUERY_BUDGETS[name], f"{name} ran {queries} queries"
+
+
+@pytest.mark.django_db(transaction=True, databases="__all__")
+def test_api_throughput_benchmark():
+    flows = scaled(20)
+    # The in-memory sqlite test database fails instead of waiting
+    # on locks, so it is only driven from one thread
+    default_workers = 1 if connection.vendor == "sqlite" else 4
+    workers = int(os.getenv("CHAT_BENCHMARK_WORKERS", default_workers))
+    users = UserFactory.create_batch(size=flows * 2)
+
+    def flow(number):
+        try:
+            return run_flow(users[number * 2], users[number * 2 + 1])
+        finally:
+            connection.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = [
+            result
+            for flow_results in executor.map(flow, range(flows))
+            for result in flow_results
+        ]
+    seconds = time.perf_counter() - started
+
+    summary = summarize(results, seconds)
+    record("api_flow", flows=flows, workers=workers, **summary)
+
+    for name, endpoint in summary["endpoints"].items():
+        assert endpoint["max_queries"] <= QUERY_BUDGETS[name], name
@@ -0,0 +1,50 @@
+import jwt
+import pytest
+import timeit
+
+from django.conf import settings
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.authentication import (
+    JWTAuthentication,
+    JWTStatelessUserAuthentication,
+)
+
+from .utils import record, scaled
+
+
+@pytest.mark.django_db
+def test_stateless_auth_benchmark(user_factory, django_assert_num_queries):
+    user = user_factory.create()
+    access_token = RefreshToken.for_user(user).access_token
+    request = APIRequestFactory().put(
+        "/api/leave-room/", HTTP_AUTHORIZATION=f"Bearer {access_token}"
+    )
+    iterations = scaled(500)
+
+    # What every authenticated request used to pay: a user query
+    # and a second decode of the token inside the view
+    def database_user_auth():
+        user, validated_token = JWTAuthentication().authenticate(request)
+        jwt.decode(validated_token.token, settings.SECRET_KEY, algorithms=["HS256"])
+        return user.id
+
+    def stateless_auth():
+        user, validated_token = JWTStatelessUserAuthentication().authenticate(request)
+        return user.id
+
+    with django_assert_num_queries(0):
+        assert stateless_auth() == user.id
+
+    database_user_time = timeit.timeit(database_user_auth, number=iterations)
+    stateless_time = timeit.timeit(stateless_auth, number=iterations)
+
+    record(
+        "stateless_auth",
+        iterations=iterations,
+        database_user_us=database_user_time / iterations * 1e6,
+        stateless_us=stateless_time / iterations * 1e6,
+        saved_us=(database_user_time - stateless_time) / iterations * 1e6,
+    )
+
+    assert stateless_time < database_user_time
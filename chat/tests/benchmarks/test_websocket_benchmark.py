@@ -0,0 +1,96 @@
+import time
+import asyncio
+
+import pytest
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from chat.models import Message
+from chat.routing import websocket_urlpatterns
+from chat.persistence import message_buffer
+from .utils import percentile, record, scaled
+
+
+application = URLRouter(websocket_urlpatterns)
+
+
+'''
+Connects clients spread over rooms, has one client of every room
+send messages and measures how long each copy takes to reach the
+members, including the batched database write of every message
+'''
+@pytest.mark.django_db
+def test_websocket_fanout_benchmark(
+    channel_layer, anonymous_messages, user_factory, room_factory
+):
+    room_count = scaled(20)
+    clients_per_room = 10
+    messages_per_room = 5
+    user = user_factory.create()
+    rooms = room_factory.create_batch(size=room_count, max_participants=5)
+
+    async def run():
+        communicators = {
+            room.id: [
+                WebsocketCommunicator(application, f"/ws/chat/{room.code}/")
+                for _ in range(clients_per_room)
+            ]
+            for room in rooms
+        }
+        everyone = [c for room_clients in communicators.values() for c in room_clients]
+
+        started = time.perf_counter()
+        await asyncio.gather(*(c.connect(timeout=30) for c in everyone))
+        connect_seconds = time.perf_counter() - started
+
+        sent_at = {}
+        latencies = []
+
+        async def listen(communicator):
+            for _ in range(messages_per_room):
+                response = await communicator.receive_json_from(timeout=30)
+                latencies.append(
+                    time.perf_counter() - sent_at[response["message"]["text"]]
+                )
+
+        async def talk(room):
+            sender = communicators[room.id][0]
+            for number in range(messages_per_room):
+                text = f"{room.id}-{number}"
+                sent_at[text] = time.perf_counter()
+                await sender.send_json_to(
+                    {"message": {"user": user.id, "roomId": room.id, "text": text}}
+                )
+
+        started = time.perf_counter()
+        listeners = [asyncio.ensure_future(listen(c)) for c in everyone]
+        await asyncio.gather(*(talk(room) for room in rooms))
+        await asyncio.gather(*listeners)
+        await message_buffer.flush()
+        for task in list(message_buffer.tasks):
+            await task
+        fanout_seconds = time.perf_counter() - started
+
+        await asyncio.gather(*(c.disconnect() for c in everyone))
+        return connect_seconds, fanout_seconds, latencies
+
+    connect_seconds, fanout_seconds, latencies = async_to_sync(run)()
+    clients = room_count * clients_per_room
+    messages = room_count * messages_per_room
+
+    record(
+        "websocket_fanout",
+        rooms=room_count,
+        clients=clients,
+        messages=messages,
+        connects_per_sec=clients / connect_seconds,
+        messages_per_sec=messages / fanout_seconds,
+        deliveries_per_sec=len(latencies) / fanout_seconds,
+        fanout_p50_ms=percentile(latencies, 50) * 1000,
+        fanout_p99_ms=percentile(latencies, 99) * 1000,
+    )
+
+    assert len(latencies) == clients * messages_per_room
+
+    assert Message.objects.count() == messages
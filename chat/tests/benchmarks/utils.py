@@ -0,0 +1,37 @@
+import os
+import json
+import time
+
+
+'''
+Benchmarks run with small sizes in the normal test run,
+CHAT_BENCHMARK_SCALE multiplies them for real measurements
+'''
+def scaled(value):
+    return int(value * float(os.getenv("CHAT_BENCHMARK_SCALE", 1)))
+
+
+'''
+Prints a benchmark result and, when CHAT_BENCHMARK_OUTPUT is
+set, appends it as a json line to that file so results can be
+compared between releases
+'''
+def record(name, **results):
+    result = {"benchmark": name, "time": time.time(), **results}
+    print(json.dumps(result))
+
+    output = os.getenv("CHAT_BENCHMARK_OUTPUT")
+    if output:
+        with open(output, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+'''
+Returns the given percentile of a list of samples
+'''
+def percentile(samples, percent):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(len(samples) * percent / 100))
+    return samples[index]
@@ -1,7 +1,12 @@
 import pytest
 from pytest_factoryboy import register
 from rest_framework.test import APIClient
+from django.core.cache import cache
 
+from chat.cache import recent_messages
+from chat.presence import presence
+from chat.coalescing import event_coalescer
+from chat.replay import replay_buffer
 from .factories import UserFactory, RoomFactory, MessageFactory
 
 
@@ -15,3 +20,32 @@ register(MessageFactory)
 @pytest.fixture
 def client():
     return APIClient()
+
+
+@pytest.fixture
+def channel_layer(settings):
+    settings.CHANNEL_LAYERS = {
+        "default": {"BACKEND": "chat.layers.LocalFanoutChannelLayer"}
+    }
+
+
+@pytest.fixture
+def anonymous_messages(settings):
+    settings.CHAT_ANONYMOUS_MESSAGES = True
+
+
+@pytest.fixture(autouse=True)
+def local_cache(settings):
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+
+
+@pytest.fixture(autouse=True)
+def clear_caches(local_cache):
+    yield
+    recent_messages.clear()
+    presence.clear()
+    event_coalescer.clear()
+    replay_buffer.clear()
+    cache.clear()
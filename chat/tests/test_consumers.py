@@ -0,0 +1,588 @@
+import asyncio
+
+import pytest
+import msgpack
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import OperationalError
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from chat import consumers, rooms
+from chat.models import Message
+from chat.routing import websocket_urlpatterns
+from chat.codecs import CODECS, encode_frames, frame_for
+from chat.ratelimit import TokenBucket
+from chat.middleware import JWTAuthMiddlewareStack, get_token_user
+from chat.persistence import (
+    MessageBufferFull,
+    MessageIdGenerator,
+    MessageWriteBuffer,
+    message_buffer,
+)
+
+
+application = URLRouter(websocket_urlpatterns)
+
+
+def test_message_id_generator():
+    generator = MessageIdGenerator(node_id=3)
+    ids = [generator.next_id() for _ in range(1000)]
+
+    assert ids == sorted(ids)
+
+    assert len(set(ids)) == len(ids)
+
+    assert max(ids) < 2**53
+
+
+@pytest.mark.django_db
+def test_message_write_buffer_flushes_on_size(user_factory, room_factory):
+    user = user_factory.create()
+    room = room_factory.create()
+    buffer = MessageWriteBuffer(max_size=5, flush_interval=60)
+
+    async def send_messages():
+        messages = [buffer.add(room.id, user.id, f"text-{i}") for i in range(5)]
+        for task in list(buffer.tasks):
+            await task
+        return messages
+
+    messages = async_to_sync(send_messages)()
+
+    assert buffer.pending == []
+
+    assert set(Message.objects.values_list("id", flat=True)) == {
+        message.id for message in messages
+    }
+
+
+@pytest.mark.django_db
+def test_message_write_buffer_drops_taken_ids(message_factory):
+    taken = message_factory.create()
+    buffer = MessageWriteBuffer()
+
+    async def send_messages():
+        message = buffer.add(taken.room_id, taken.user_id, "text")
+        other = buffer.add(taken.room_id, taken.user_id, "other")
+        message.id = taken.id
+        await buffer.flush()
+        return message, other
+
+    message, other = async_to_sync(send_messages)()
+
+    # Clients already saw the id, the message is not renumbered
+    assert message.id == taken.id
+
+    assert set(Message.objects.values_list("id", flat=True)) == {taken.id, other.id}
+
+
+@pytest.mark.django_db
+def test_message_write_buffer_retries_failed_writes(
+    monkeypatch, user_factory, room_factory
+):
+    user = user_factory.create()
+    room = room_factory.create()
+    buffer = MessageWriteBuffer(
+        max_size=1, limit=2, retry_delay=0.01, max_retry_delay=0.02
+    )
+    write = buffer.write
+    failures = []
+
+    def flaky_write(batch):
+        if len(failures) < 3:
+            failures.append(len(batch))
+            raise OperationalError("connection lost")
+        write(batch)
+
+    monkeypatch.setattr(buffer, "write", flaky_write)
+
+    async def send_messages():
+        messages = [buffer.add(room.id, user.id, "first")]
+        await asyncio.sleep(0)
+        messages.append(buffer.add(room.id, user.id, "second"))
+        with pytest.raises(MessageBufferFull):
+            buffer.add(room.id, user.id, "refused")
+        while buffer.tasks or buffer.timer is not None:
+            await asyncio.sleep(0.01)
+        return messages
+
+    messages = async_to_sync(send_messages)()
+
+    # Nothing already broadcast is dropped, however often writes fail
+    assert len(failures) == 3
+
+    assert buffer.pending == [] and buffer.failures == 0
+
+    assert sorted(Message.objects.values_list("id", flat=True)) == [
+        message.id for message in messages
+    ]
+
+
+def test_message_write_buffer_leases_node_ids():
+    first, second = MessageWriteBuffer(), MessageWriteBuffer()
+
+    assert first.lease.current() != second.lease.current()
+
+    assert first.lease.current() == first.lease.current()
+
+
+@pytest.mark.django_db
+def test_chat_consumer_message(channel_layer, monkeypatch, user_factory, room_factory):
+    user = user_factory.create()
+    room = room_factory.create()
+    lookups = []
+    aget_room = consumers.aget_room
+
+    async def counted_aget_room(code):
+        lookups.append(code)
+        return await aget_room(code)
+
+    monkeypatch.setattr(consumers, "aget_room", counted_aget_room)
+    access_token = str(RefreshToken.for_user(user).access_token)
+
+    async def chat():
+        communicator = WebsocketCommunicator(
+            JWTAuthMiddlewareStack(application),
+            f"/ws/chat/{room.code}/?token={access_token}",
+        )
+        anonymous = WebsocketCommunicator(application, f"/ws/chat/{room.code}/")
+        connected, _ = await communicator.connect()
+        assert connected
+        await anonymous.connect()
+
+        await anonymous.send_json_to(
+            {"message": {"user": user.id, "roomId": room.id, "text": "spoofed"}}
+        )
+        refused = await anonymous.receive_json_from()
+        for text in ("first", "hello"):
+            await communicator.send_json_to(
+                {"message": {"roomId": room.id, "text": text}}
+            )
+            response = await communicator.receive_json_from()
+        await communicator.disconnect()
+        await anonymous.disconnect()
+        await message_buffer.flush()
+        return refused, response
+
+    refused, response = async_to_sync(chat)()
+
+    assert refused == {"room": room.code, "error": "Sign in to send messages"}
+
+    # The room is looked up once per connection, not per message
+    assert lookups == [room.code, room.code]
+
+    assert response["message"]["text"] == "hello"
+
+    assert Message.objects.get(id=response["message"]["id"]).room_id == room.id
+
+
+@pytest.mark.django_db
+def test_chat_consumer_validates_frames(
+    channel_layer, anonymous_messages, settings, user_factory, room_factory
+):
+    settings.CHAT_MAX_MESSAGE_LENGTH = 10
+    user = user_factory.create()
+    room = room_factory.create()
+
+    async def chat():
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{room.code}/")
+        await communicator.connect()
+
+        errors = []
+        for frame in (
+            {"message": {"user": user.id, "roomId": room.id, "text": "x" * 11}},
+            {"message": {"user": user.id, "text": "hi", "html": "<b>hi</b>"}},
+            {"message": {"user": user.id, "roomId": room.id + 1, "text": "hi"}},
+            {"message": {"user": user.id, "roomId": "\u00b2", "text": "hi"}},
+            {"message": {"roomId": room.id, "text": "hi"}},
+            {"event": {"type": "typing", "nested": {"a": 1}}},
+            {"message": {"user": user.id, "text": "hi"}, "extra": True},
+        ):
+            await communicator.send_json_to(frame)
+            errors.append((await communicator.receive_json_from())["error"])
+        await communicator.send_to(text_data="not json")
+        errors.append((await communicator.receive_json_from())["error"])
+
+        await communicator.send_json_to({"message": {"user": user.id, "text": "hi"}})
+        response = await communicator.receive_json_from()
+        await communicator.disconnect()
+        await message_buffer.flush()
+        return errors, response
+
+    errors, response = async_to_sync(chat)()
+
+    assert errors == [
+        "Message text is too long",
+        "Unknown message fields",
+        "Invalid room id",
+        "Invalid room id",
+        "Missing user",
+        "Invalid event value",
+        "Unknown frame fields",
+        "Invalid frame",
+    ]
+
+    message = Message.objects.get()
+    assert response == {
+        "room": room.code,
+        "message": {"user": user.id, "roomId": room.id, "text": "hi", "id": message.id},
+    }
+
+
+@pytest.mark.django_db
+def test_get_token_user(user_factory, django_assert_num_queries):
+    user = user_factory.create()
+    access_token = str(RefreshToken.for_user(user).access_token)
+
+    with django_assert_num_queries(0):
+        token_user = get_token_user(access_token)
+        invalid_token_user = get_token_user(access_token + "x")
+
+        assert token_user.is_authenticated
+
+        assert token_user.id == user.id
+
+        assert not invalid_token_user.is_authenticated
+
+
+@pytest.mark.django_db
+def test_chat_consumer_token_user(channel_layer, user_factory, room_factory):
+    user = user_factory.create()
+    other_user = user_factory.create()
+    room = room_factory.create()
+    access_token = str(RefreshToken.for_user(user).access_token)
+
+    async def chat():
+        communicator = WebsocketCommunicator(
+            JWTAuthMiddlewareStack(application),
+            f"/ws/chat/{room.code}/",
+            subprotocols=[f"jwt.{access_token}"],
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        assert subprotocol == f"jwt.{access_token}"
+
+        await communicator.send_json_to(
+            {"message": {"user": other_user.id, "roomId": room.id, "text": "hello"}}
+        )
+        response = await communicator.receive_json_from()
+        await communicator.disconnect()
+        await message_buffer.flush()
+        return response
+
+    response = async_to_sync(chat)()
+
+    assert response["message"]["user"] == user.id
+
+    assert Message.objects.get(id=response["message"]["id"]).user_id == user.id
+
+
+@pytest.mark.django_db
+def test_chat_consumer_codecs(
+    channel_layer, anonymous_messages, user_factory, room_factory
+):
+    user = user_factory.create()
+    room = room_factory.create()
+
+    async def chat():
+        json_client = WebsocketCommunicator(application, f"/ws/chat/{room.code}/")
+        msgpack_client = WebsocketCommunicator(
+            application, f"/ws/chat/{room.code}/", subprotocols=["chat.msgpack"]
+        )
+        await json_client.connect()
+        _, subprotocol = await msgpack_client.connect()
+        assert subprotocol == "chat.msgpack"
+
+        await msgpack_client.send_to(
+            bytes_data=msgpack.packb(
+                {"message": {"user": user.id, "roomId": room.id, "text": "hello"}}
+            )
+        )
+        json_response = await json_client.receive_json_from()
+        msgpack_response = msgpack.unpackb(await msgpack_client.receive_from())
+        await json_client.disconnect()
+        await msgpack_client.disconnect()
+        await message_buffer.flush()
+        return json_response, msgpack_response
+
+    json_response, msgpack_response = async_to_sync(chat)()
+
+    assert json_response == msgpack_response
+
+    assert json_response["message"]["text"] == "hello"
+
+
+def test_frames_are_encoded_per_codec_on_first_use():
+    frames = encode_frames({"room": "ABCDEF", "message": {"text": "hi"}})
+
+    assert list(frames) == ["json"]
+
+    frame = frame_for(frames, CODECS["msgpack"])
+
+    assert msgpack.unpackb(frame) == {"room": "ABCDEF", "message": {"text": "hi"}}
+
+    assert frame_for(frames, CODECS["msgpack"]) is frame
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    now = bucket.updated
+
+    assert [bucket.consume(now) for _ in range(3)] == [True, True, False]
+
+    assert bucket.delay(now) == pytest.approx(0.1)
+
+    assert bucket.consume(now + 0.11)
+
+
+@pytest.mark.django_db
+def test_chat_consumer_rate_limits(
+    channel_layer, anonymous_messages, settings, user_factory, room_factory
+):
+    settings.CHAT_RATE_CONNECTION_EVENTS = (20, 2)
+    settings.CHAT_RATE_CONNECTION_MESSAGES = (0.01, 1)
+    user = user_factory.create()
+    room = room_factory.create()
+
+    async def chat():
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{room.code}/")
+        await communicator.connect()
+        for number in range(5):
+            await communicator.send_json_to({"event": {"typing": number}})
+        events = [await communicator.receive_json_from() for _ in range(3)]
+
+        message = {"message": {"user": user.id, "roomId": room.id, "text": "hello"}}
+        await communicator.send_json_to(message)
+        await communicator.receive_json_from()
+        await communicator.send_json_to(message)
+        refused = await communicator.receive_json_from()
+        await communicator.disconnect()
+        await message_buffer.flush()
+        return events, refused
+
+    events, refused = async_to_sync(chat)()
+
+    # The last three events are merged into the latest one
+    assert [event["event"]["typing"] for event in events] == [0, 1, 4]
+
+    assert refused == {"room": room.code, "error": "Too many messages"}
+
+
+@pytest.mark.django_db
+def test_chat_consumer_event_coalescing(channel_layer, room_factory):
+    room = room_factory.create()
+
+    async def chat():
+        sender = WebsocketCommunicator(application, f"/ws/chat/{room.code}/")
+        listener = WebsocketCommunicator(
+            application, f"/ws/chat/{room.code}/?batch=1"
+        )
+        await sender.connect()
+        await listener.connect()
+        for event in (
+            {"type": "typing", "value": 0},
+            {"type": "typing", "value": 1},
+            {"reaction": "+1"},
+            {"type": "typing", "value": 2},
+        ):
+            await sender.send_json_to({"event": event})
+        sent = [await sender.receive_json_from() for _ in range(2)]
+        batched = await listener.receive_json_from()
+        await listener.receive_nothing()
+        await sender.disconnect()
+        await listener.disconnect()
+        return sent, batched
+
+    sent, batched = async_to_sync(chat)()
+
+    events = [{"reaction": "+1"}, {"type": "typing", "value": 2}]
+
+    assert batched == {"room": room.code, "events": events}
+
+    assert sent == [{"room": room.code, "event": event} for event in events]
+
+
+@pytest.mark.django_db
+def test_chat_consumer_resume(
+    channel_layer, anonymous_messages, user_factory, room_factory, message_factory
+):
+    user = user_factory.create()
+    room = room_factory.create()
+    history = message_factory.create_batch(size=3, room=room, user=user)
+
+    async def chat():
+        url = f"/ws/chat/{room.code}/?last_seen_id="
+        from_database = WebsocketCommunicator(application, f"{url}{history[0].id}")
+        await from_database.connect()
+        database_replay = [await from_database.receive_json_from() for _ in range(2)]
+
+        for number in range(3):
+            await from_database.send_json_to(
+                {"message": {"user": user.id, "roomId": room.id, "text": f"{number}"}}
+            )
+        live = [await from_database.receive_json_from() for _ in range(3)]
+
+        from_memory = WebsocketCommunicator(
+            application, f"{url}{live[0]['message']['id']}"
+        )
+        await from_memory.connect()
+        memory_replay = [await from_memory.receive_json_from() for _ in range(2)]
+        await from_memory.receive_nothing()
+        await from_database.disconnect()
+        await from_memory.disconnect()
+        await message_buffer.flush()
+        return database_replay, live, memory_replay
+
+    database_replay, live, memory_replay = async_to_sync(chat)()
+
+    assert [m["message"]["id"] for m in database_replay] == [m.id for m in history[1:]]
+
+    assert memory_replay == live[1:]
+
+
+@pytest.mark.django_db
+def test_multiplex_chat_consumer(
+    channel_layer, anonymous_messages, user_factory, room_factory
+):
+    user = user_factory.create()
+    first_room, second_room = room_factory.create_batch(size=2)
+
+    async def chat():
+        multiplexed = WebsocketCommunicator(application, "/ws/chat/")
+        single = WebsocketCommunicator(application, f"/ws/chat/{second_room.code}/")
+        await multiplexed.connect()
+        await single.connect()
+
+        subscribed = []
+        for room in (first_room, second_room):
+            await multiplexed.send_json_to({"subscribe": room.code})
+            subscribed.append(await multiplexed.receive_json_from())
+
+        await multiplexed.send_json_to(
+            {
+                "room": first_room.code,
+                "message": {"user": user.id, "roomId": first_room.id, "text": "first"},
+            }
+        )
+        first = await multiplexed.receive_json_from()
+        await single.send_json_to(
+            {"message": {"user": user.id, "roomId": second_room.id, "text": "second"}}
+        )
+        second = await multiplexed.receive_json_from()
+
+        await multiplexed.send_json_to({"unsubscribe": second_room.code})
+        await single.send_json_to(
+            {"message": {"user": user.id, "roomId": second_room.id, "text": "gone"}}
+        )
+        await multiplexed.send_json_to({"room": second_room.code, "event": {}})
+        refused = await multiplexed.receive_json_from()
+        await multiplexed.disconnect()
+        await single.disconnect()
+        await message_buffer.flush()
+        return subscribed, first, second, refused
+
+    subscribed, first, second, refused = async_to_sync(chat)()
+
+    assert subscribed == [
+        {"room": first_room.code, "subscribed": True},
+        {"room": second_room.code, "subscribed": True},
+    ]
+
+    assert (first["room"], first["message"]["text"]) == (first_room.code, "first")
+
+    assert (second["room"], second["message"]["text"]) == (second_room.code, "second")
+
+    assert refused == {"room": second_room.code, "error": "Not subscribed to the room"}
+
+
+@pytest.mark.django_db
+def test_room_lifecycle_events(
+    channel_layer,
+    settings,
+    user_factory,
+    room_factory,
+    django_capture_on_commit_callbacks,
+):
+    settings.CHAT_LOBBY_EVENTS = True
+    host, user = user_factory.create_batch(size=2)
+    room = room_factory.create(host_id=host.id, max_participants=3)
+    access_token = str(RefreshToken.for_user(user).access_token)
+
+    def change_room():
+        with django_capture_on_commit_callbacks(execute=True):
+            rooms.join_room(room.code, user.id)
+            rooms.leave_room(room.code, host.id)
+
+    async def chat():
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{room.code}/")
+        lobby = WebsocketCommunicator(
+            JWTAuthMiddlewareStack(application), f"/ws/lobby/?token={access_token}"
+        )
+        anonymous_lobby = WebsocketCommunicator(
+            JWTAuthMiddlewareStack(application), "/ws/lobby/"
+        )
+        await communicator.connect()
+        await lobby.connect()
+        anonymous_connected, _ = await anonymous_lobby.connect()
+
+        await database_sync_to_async(change_room)()
+        events = [await communicator.receive_json_from() for _ in range(2)]
+        lobby_events = [await lobby.receive_json_from() for _ in range(2)]
+        await communicator.send_json_to({"message": {"text": "late"}})
+        refused = await communicator.receive_json_from()
+        await communicator.disconnect()
+        await lobby.disconnect()
+        return events, lobby_events, anonymous_connected, refused
+
+    events, lobby_events, anonymous_connected, refused = async_to_sync(chat)()
+
+    assert events == [
+        {
+            "room": room.code,
+            "room_event": {
+                "type": "participants",
+                "participants": 1,
+                "max_participants": 3,
+            },
+        },
+        {"room": room.code, "room_event": {"type": "closed"}},
+    ]
+
+    assert lobby_events == events
+
+    assert not anonymous_connected
+
+    assert refused == {"room": room.code, "error": "Room not found"}
+
+
+@pytest.mark.django_db
+def test_chat_consumer_slow_reader_is_closed(settings, room_factory):
+    settings.CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat.layers.LocalFanoutChannelLayer",
+            "CONFIG": {"capacity": 2},
+        }
+    }
+    room = room_factory.create()
+
+    async def chat():
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{room.code}/")
+        await communicator.connect()
+        layer = get_channel_layer()
+        # Nothing is received in between, the third message overflows
+        for number in range(3):
+            await layer.group_send(
+                f"chat_{room.code}",
+                {"type": "chat_event", "frames": {"json": f"{number}"}},
+            )
+        output = await communicator.receive_output()
+        await communicator.wait()
+        return output
+
+    output = async_to_sync(chat)()
+
+    assert output == {"type": "websocket.close", "code": 1013}
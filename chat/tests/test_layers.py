@@ -0,0 +1,114 @@
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+
+from chat.layers import LocalFanoutChannelLayer
+
+
+'''
+Two nodes sharing an in-memory layer that stands in for Redis
+'''
+def make_nodes():
+    remote = InMemoryChannelLayer()
+    remote_group_sends = []
+    remote_group_send = remote.group_send
+
+    async def counted_group_send(group, message):
+        remote_group_sends.append(message["type"])
+        await remote_group_send(group, message)
+
+    remote.group_send = counted_group_send
+    return (
+        LocalFanoutChannelLayer(remote=remote),
+        LocalFanoutChannelLayer(remote=remote),
+        remote_group_sends,
+    )
+
+
+def test_local_fanout_layer_local_group():
+    node, _, remote_group_sends = make_nodes()
+
+    async def send():
+        first_channel = await node.new_channel()
+        second_channel = await node.new_channel()
+        await node.group_add("chat_room", first_channel)
+        await node.group_add("chat_room", second_channel)
+        await asyncio.sleep(0.01)
+        remote_group_sends.clear()
+
+        await node.group_send("chat_room", {"type": "chat.message", "text": "hi"})
+        received = [
+            await node.receive(first_channel),
+            await node.receive(second_channel),
+        ]
+        await node.close()
+        return received
+
+    received = async_to_sync(send)()
+
+    assert [message["text"] for message in received] == ["hi", "hi"]
+
+    assert remote_group_sends == []
+
+
+def test_local_fanout_layer_remote_group():
+    first_node, second_node, remote_group_sends = make_nodes()
+
+    async def send():
+        first_channel = await first_node.new_channel()
+        second_channel = await second_node.new_channel()
+        await first_node.group_add("chat_room", first_channel)
+        await second_node.group_add("chat_room", second_channel)
+        await asyncio.sleep(0.01)
+        remote_group_sends.clear()
+
+        await first_node.group_send("chat_room", {"type": "chat.message", "text": "hi"})
+        received = [
+            await first_node.receive(first_channel),
+            await asyncio.wait_for(second_node.receive(second_channel), 1),
+        ]
+
+        await second_node.send(first_channel, {"type": "chat.message", "text": "dm"})
+        received.append(await asyncio.wait_for(first_node.receive(first_channel), 1))
+
+        await first_node.close()
+        await second_node.close()
+        return received
+
+    received = async_to_sync(send)()
+
+    assert [message["text"] for message in received] == ["hi", "hi", "dm"]
+
+    assert remote_group_sends == ["node.group"]
+
+
+def test_local_fanout_layer_expiry_and_group_refresh():
+    remote = InMemoryChannelLayer()
+    node = LocalFanoutChannelLayer(remote=remote, expiry=0.01, group_refresh=0.01)
+
+    async def send():
+        gone_channel = await node.new_channel()
+        live_channel = await node.new_channel()
+        await node.group_add("chat_room", gone_channel)
+        await node.group_add("chat_lobby", live_channel)
+        await node.group_send("chat_room", {"type": "chat.message", "text": "late"})
+        await node.group_discard("chat_room", gone_channel)
+        # The remote forgot the node, like channels_redis after group_expiry
+        remote.groups.clear()
+        await asyncio.sleep(0.05)
+
+        await node.group_send("chat_lobby", {"type": "chat.message", "text": "hi"})
+        channels = set(node.channels)
+        received = await node.receive(live_channel)
+        remote_groups = set(remote.groups)
+        await node.close()
+        return gone_channel, channels, received, remote_groups
+
+    gone_channel, channels, received, remote_groups = async_to_sync(send)()
+
+    assert gone_channel not in channels
+
+    assert received["text"] == "hi"
+
+    assert remote_groups == {"chat_lobby"}
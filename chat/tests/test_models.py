@@ -1,7 +1,10 @@
 import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from django.db import OperationalError, connection
 from django.contrib.auth.models import User
-from chat.models import Room, Message
+from chat.models import Room, Message, RoomCodeAllocator, room_codes
 
 
 @pytest.mark.django_db
@@ -37,3 +40,60 @@ def test_create_message_model(message_factory):
     assert new_message.room == Room.objects.last()
 
     assert str(new_message) == new_message.text
+
+
+# Reads outside transactions go to replicas when DB_REPLICA_URLS is set
+@pytest.mark.django_db(transaction=True, databases="__all__")
+def test_room_join_concurrency(room_factory):
+    room = room_factory.create(max_participants=5)
+    start = threading.Barrier(16)
+
+    def join(_):
+        try:
+            start.wait()
+            while True:
+                try:
+                    return Room.objects.join(room.code) is not None
+                except OperationalError as error:
+                    # The in-memory sqlite test database fails fast instead of
+                    # waiting on its lock, the statement was not applied
+                    if "locked" not in str(error):
+                        raise
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(join, range(16)))
+
+    room.refresh_from_db()
+
+    assert results.count(True) == 5
+
+    assert room.participants == 5
+
+
+def test_room_code_allocator():
+    allocator = RoomCodeAllocator()
+    codes = [allocator.next_code() for _ in range(1000)]
+
+    assert all(len(code) == 6 and code.isalpha() and code.isupper() for code in codes)
+
+    numbers = [
+        sum(26 ** place * (ord(char) - 65) for place, char in enumerate(code))
+        for code in codes
+    ]
+    steps = {(b - a) % 26 ** 6 for a, b in zip(numbers, numbers[1:])}
+    assert len(steps) > 1
+
+
+@pytest.mark.django_db
+def test_room_code_collision(room_factory, monkeypatch):
+    taken_room = room_factory.create()
+    codes = iter([taken_room.code, "FRESHC"])
+    monkeypatch.setattr(room_codes, "next_code", lambda: next(codes))
+
+    new_room = room_factory.create()
+
+    assert new_room.code == "FRESHC"
+
+    assert Room.objects.count() == 2
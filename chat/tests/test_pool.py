@@ -0,0 +1,86 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from chat.db.pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+
+    def close(self):
+        self.alive = False
+
+
+def test_connection_pool_reuses_connections():
+    opened = []
+
+    def connect():
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    pool = ConnectionPool(connect, size=2, timeout=0.01)
+    first = pool.acquire()
+    pool.release(first)
+    second, third = pool.acquire(), pool.acquire()
+
+    assert second is first
+
+    assert len(opened) == 2
+
+    assert pool.stats() == {"size": 2, "open": 2, "in_use": 2, "idle": 0, "waiting": 0}
+
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    pool.release(third, discard=True)
+
+    assert not third.alive
+
+    assert pool.acquire() is not third
+
+
+def test_connection_pool_replaces_unhealthy_connections():
+    pool = ConnectionPool(
+        FakeConnection, size=1, check_interval=0, check=lambda c: c.alive
+    )
+    connection = pool.acquire()
+    pool.release(connection)
+    connection.alive = False
+
+    replacement = pool.acquire()
+
+    assert replacement is not connection
+
+    assert replacement.alive
+
+    assert pool.stats()["open"] == 1
+
+
+def test_connection_pool_bounds_connections_across_threads():
+    pool = ConnectionPool(FakeConnection, size=3, timeout=5)
+    lock = threading.Lock()
+    in_use = set()
+    most_in_use = 0
+
+    def work(_):
+        nonlocal most_in_use
+        connection = pool.acquire()
+        with lock:
+            assert connection not in in_use
+            in_use.add(connection)
+            most_in_use = max(most_in_use, len(in_use))
+        with lock:
+            in_use.discard(connection)
+        pool.release(connection)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(work, range(500)))
+
+    assert most_in_use <= 3
+
+    assert pool.stats()["open"] <= 3
+
+    assert pool.stats()["in_use"] == 0
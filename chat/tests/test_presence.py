@@ -0,0 +1,128 @@
+import time
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from chat.models import Room
+from chat.middleware import JWTAuthMiddlewareStack
+from chat.presence import PresenceStore, presence
+from chat.rooms import join_room, leave_room, release_seats, seat_key
+from .test_consumers import application
+
+
+def test_presence_store():
+    store = PresenceStore(grace=10, flush_interval=60)
+
+    async def connect():
+        store.connect("ROOM", "first", user_id=1)
+        store.connect("ROOM", "second", user_id=1)
+        store.connect("ROOM", "anonymous")
+        store.connect("ROOM", "third", user_id=2)
+        store.connect("ROOM", "fourth", user_id=3)
+        members = (store.count("ROOM"), sorted(store.members("ROOM")))
+
+        store.disconnect("first", abandoned=True)
+        store.disconnect("second", abandoned=True)
+        store.disconnect("third")
+        store.timer.cancel()
+        return members
+
+    members = async_to_sync(connect)()
+    now = time.monotonic()
+
+    assert members == (4, [1, 2, 3])
+
+    assert store.count("ROOM") == 2
+
+    assert store.sweep(now) == {}
+
+    assert store.sweep(now + 11) == {"ROOM": [1]}
+
+    # Idle connections never expire, only closed sockets leave
+    assert store.sweep(now + 3600) == {}
+
+    assert store.count("ROOM") == 2
+
+
+@pytest.mark.django_db
+def test_release_seats(user_factory, room_factory):
+    first_user, second_user, watcher = user_factory.create_batch(size=3)
+    first, second = room_factory.create_batch(size=2)
+    for user in (first_user, second_user):
+        join_room(first.code, user.id)
+    join_room(second.code, first_user.id)
+    join_room(second.code, second_user.id)
+    leave_room(second.code, second_user.id)
+
+    releases = release_seats(
+        {
+            first.code: [first_user.id, second_user.id, watcher.id],
+            second.code: [first_user.id, second_user.id],
+        }
+    )
+
+    assert releases == {first.code: 2, second.code: 1}
+
+    assert [
+        Room.objects.get(id=room.id).participants for room in (first, second)
+    ] == [0, 0]
+
+    assert release_seats({first.code: [first_user.id]}) == {}
+
+
+@pytest.mark.django_db
+def test_join_room_takes_one_seat_per_user(user_factory, room_factory):
+    user = user_factory.create()
+    room = room_factory.create()
+
+    join_room(room.code, user.id)
+    join_room(room.code, user.id)
+
+    assert Room.objects.get(id=room.id).participants == 1
+
+
+@pytest.mark.django_db
+def test_leave_room_without_seat_record(user_factory, room_factory):
+    first_user, second_user = user_factory.create_batch(size=2)
+    room = room_factory.create(participants=2, max_participants=5)
+    join_room(room.code, second_user.id)
+    join_room(room.code, first_user.id)
+    # The record of the first user's seat was evicted
+    cache.delete(seat_key(room.code, first_user.id))
+
+    for _ in range(2):
+        leave_room(room.code, first_user.id)
+
+    release_seats({room.code: [second_user.id]})
+    leave_room(room.code, second_user.id)
+
+    assert Room.objects.get(id=room.id).participants == 2
+
+
+@pytest.mark.django_db
+def test_chat_consumer_presence(channel_layer, user_factory, room_factory):
+    user = user_factory.create()
+    room = room_factory.create()
+    access_token = str(RefreshToken.for_user(user).access_token)
+
+    async def chat():
+        communicator = WebsocketCommunicator(
+            JWTAuthMiddlewareStack(application),
+            f"/ws/chat/{room.code}/?token={access_token}",
+        )
+        await communicator.connect()
+        await communicator.send_json_to({"presence": True})
+        response = await communicator.receive_json_from()
+        await communicator.disconnect(code=1006)
+        return response
+
+    response = async_to_sync(chat)()
+
+    assert response["presence"] == {"count": 1, "members": [user.id]}
+
+    assert presence.count(room.code) == 0
+
+    assert presence.sweep(time.monotonic() + presence.grace) == {room.code: [user.id]}
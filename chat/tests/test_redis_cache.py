@@ -0,0 +1,40 @@
+from chat.redis_cache import RedisCache
+
+
+def test_redis_cache_serialization():
+    cache = RedisCache("redis://localhost:6379/1", {"TIMEOUT": 300})
+
+    assert cache.loads(b"12") == 12
+
+    assert cache.loads(cache.dumps({"room": None})) == {"room": None}
+
+    assert cache.loads(cache.dumps(True)) is True
+
+    assert [cache.expiry(timeout) for timeout in (None, 0, 2.5)] == [None, 0, 2]
+
+    assert cache.key("room") == ":1:room"
+
+
+class FakeRedis:
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.pattern = None
+
+    def scan_iter(self, match, count):
+        self.pattern = match
+        prefix = match[:-1].replace("\\", "")
+        return [key for key in sorted(self.keys) if key.startswith(prefix)]
+
+    def delete(self, *keys):
+        self.keys -= set(keys)
+
+
+def test_redis_cache_clear_keeps_other_keys():
+    cache = RedisCache("redis://localhost:6379/0", {"KEY_PREFIX": "chat[1]"})
+    cache._client = FakeRedis(["chat[1]:1:room", "asgi:group:chat_lobby"])
+
+    cache.clear()
+
+    assert cache.client.pattern == "chat\\[1\\]:*"
+
+    assert cache.client.keys == {"asgi:group:chat_lobby"}
@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+from django.core.management import call_command
+
+from chat.models import ClosedRoom, Message, MessageArchive, Room
+from chat.rooms import leave_room
+from chat.retention import run_retention
+
+
+@pytest.mark.django_db
+def test_closed_room_messages_are_archived(
+    user_factory, room_factory, message_factory, django_assert_max_num_queries
+):
+    host = user_factory.create()
+    room = room_factory.create(host_id=host.id)
+    messages = message_factory.create_batch(size=5, room=room, user=host)
+
+    with django_assert_max_num_queries(6):
+        assert leave_room(room.code, host.id)
+
+    assert not Room.objects.filter(id=room.id).exists()
+
+    assert Message.objects.filter(room_id=room.id).count() == 5
+
+    totals = run_retention(chunk_size=2, closed_delay=0)
+
+    assert totals == {
+        "closed_rooms": 1,
+        "closed_room_messages": 5,
+        "expired_messages": 0,
+    }
+
+    assert not Message.objects.filter(room_id=room.id).exists()
+
+    assert not ClosedRoom.objects.exists()
+
+    assert sorted(MessageArchive.objects.values_list("id", flat=True)) == sorted(
+        message.id for message in messages
+    )
+
+
+@pytest.mark.django_db
+def test_deleted_rooms_are_recorded(room_factory):
+    rooms = room_factory.create_batch(size=2)
+    room_ids = sorted(room.id for room in rooms)
+
+    rooms[0].delete()
+    Room.objects.filter(id=rooms[1].id).delete()
+
+    assert sorted(ClosedRoom.objects.values_list("room_id", flat=True)) == room_ids
+
+
+@pytest.mark.django_db
+def test_expired_messages_are_deleted_in_chunks(message_factory):
+    old_messages = message_factory.create_batch(size=3)
+    new_message = message_factory.create()
+    Message.objects.filter(id__in=[m.id for m in old_messages]).update(
+        time_sent=timezone.now() - timedelta(days=31)
+    )
+
+    call_command(
+        "message_retention", days=30, chunk_size=2, max_chunks=1, archive=False
+    )
+
+    cutoff = timezone.now() - timedelta(days=30)
+
+    assert Message.objects.filter(time_sent__lt=cutoff).count() == 1
+
+    run_retention(retention_days=30, archive=False)
+
+    assert list(Message.objects.values_list("id", flat=True)) == [new_message.id]
+
+    assert not MessageArchive.objects.exists()
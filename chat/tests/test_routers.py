@@ -0,0 +1,90 @@
+import pytest
+from django.core.cache import cache
+from django.test import RequestFactory
+from django.contrib.auth.models import User
+
+from chat.models import Message, Room
+from chat.rooms import get_room, get_rooms
+from chat.persistence import MessageWriteBuffer
+from chat.db.routers import (
+    ReplicaRouter,
+    replica_routing_middleware,
+    sticky_key,
+    use_primary,
+)
+
+
+router = ReplicaRouter()
+
+
+def routed_view(request):
+    reads = [router.db_for_read(Room)]
+    router.db_for_read(Room)
+    if request.method == "POST":
+        router.db_for_write(Room)
+        reads.append(router.db_for_read(Room))
+    return reads
+
+
+def test_replica_router(settings, monkeypatch):
+    settings.CHAT_DATABASE_REPLICAS = ["replica1"]
+    user, other_user = User(id=1), User(id=2)
+    middleware = replica_routing_middleware(routed_view)
+    factory = RequestFactory()
+    lookups = []
+    get = cache.get
+    monkeypatch.setattr(cache, "get", lambda key: lookups.append(key) or get(key))
+
+    def request(method, user):
+        # As the api views do once they authenticated the user
+        http_request = getattr(factory, method)("/")
+        http_request.user = user
+        return middleware(http_request)
+
+    assert request("get", user) == ["replica1"]
+
+    assert request("post", user) == ["replica1", "default"]
+
+    assert request("get", user) == ["default"]
+
+    assert request("get", other_user) == ["replica1"]
+
+    assert len(lookups) == 4
+
+    assert router.db_for_read(Room) == "replica1"
+
+    with use_primary():
+        assert router.db_for_read(Room) == "default"
+
+        assert router.db_for_write(Room) == "default"
+
+    assert router.allow_migrate("replica1", "chat") is False
+
+
+# replica1 is not configured in the tests, a read from it would fail.
+# Reads inside the test transaction would go to the primary anyway
+@pytest.mark.django_db(transaction=True)
+def test_cache_fills_and_message_writes_use_the_primary(
+    settings, user_factory, room_factory
+):
+    user = user_factory.create()
+    room = room_factory.create()
+    settings.CHAT_DATABASE_REPLICAS = ["replica1"]
+    settings.CHAT_ROOM_CACHE_TTL = 2
+    buffer = MessageWriteBuffer(node_id=1)
+
+    assert get_room(room.code) == room
+
+    assert get_rooms([room.code]) == {room.code: room}
+
+    buffer.write([Message(id=buffer.ids.next_id(), room=room, user=user, text="hi")])
+
+    assert cache.get(sticky_key(user.id)) is True
+
+
+def test_replica_router_without_replicas(settings):
+    settings.CHAT_DATABASE_REPLICAS = []
+
+    assert router.db_for_read(Room) == "default"
+
+    assert router.allow_migrate("default", "chat") is None
@@ -1,12 +1,16 @@
 import pytest
 
+from asgiref.sync import async_to_sync
+
 from django.urls import reverse
+from django.test import AsyncClient
 from django.contrib.auth.models import User
 from rest_framework.test import force_authenticate
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from .factories import fake
 from chat.models import Room, generate_room_code
+from chat.cache import recent_messages
 
 
 @pytest.mark.django_db
@@ -51,6 +55,7 @@ def test_create_room_view(user_factory, client):
 
     assert create_room_response.data.get("host_id") == user.id
 
+    Room.objects.update(participants=1)
     create_new_room_response = client.post(path=reverse("chat:create-room"), data=form_data)
     
     assert create_new_room_response.status_code == 201
@@ -58,6 +63,11 @@ def test_create_room_view(user_factory, client):
     assert Room.objects.count() == 1
 
     assert create_new_room_response.data.get("host_id") == user.id
+
+    # Seats taken in the room are kept, the reply shows the stored count
+    assert create_new_room_response.data.get("participants") == 1
+
+    assert Room.objects.get().participants == 1
     
 
 @pytest.mark.django_db
@@ -145,3 +155,232 @@ def test_is_room_active_view(room_factory, client):
     assert active_room_response.status_code == 200
 
     assert inactive_room_response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_get_room_message_history_view(user_factory, room_factory, message_factory, client):
+    user = user_factory.create()
+    room = room_factory.create()
+    messages = message_factory.create_batch(size=25, room=room, user=user)
+    newest_first = [message.id for message in reversed(messages)]
+
+    client.force_authenticate(user)
+    first_page = client.get(
+        path=reverse("chat:get-message-history"),
+        data={"roomId": room.id, "pageSize": 10},
+    )
+    second_page = client.get(
+        path=reverse("chat:get-message-history"),
+        data={"roomId": room.id, "pageSize": 10, "before": first_page.data["before"]},
+    )
+    last_page = client.get(
+        path=reverse("chat:get-message-history"),
+        data={"roomId": room.id, "pageSize": 10, "before": second_page.data["before"]},
+    )
+    newer_page = client.get(
+        path=reverse("chat:get-message-history"),
+        data={"roomId": room.id, "pageSize": 10, "after": last_page.data["after"]},
+    )
+    invalid_cursor_response = client.get(
+        path=reverse("chat:get-message-history"),
+        data={"roomId": room.id, "before": "not-a-cursor"},
+    )
+
+    assert [m["id"] for m in first_page.data["messages"]] == newest_first[:10]
+
+    assert first_page.data["after"] is None
+
+    assert [m["id"] for m in second_page.data["messages"]] == newest_first[10:20]
+
+    assert [m["id"] for m in last_page.data["messages"]] == newest_first[20:]
+
+    assert last_page.data["before"] is None
+
+    assert [m["id"] for m in newer_page.data["messages"]] == newest_first[10:20]
+
+    assert invalid_cursor_response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_get_room_messages_view_cache(
+    user_factory, room_factory, message_factory, client, django_assert_num_queries
+):
+    user = user_factory.create()
+    room = room_factory.create()
+    message_factory.create_batch(size=3, room=room, user=user)
+
+    client.force_authenticate(user)
+    first_response = client.get(
+        path=reverse("chat:get-messages"), data={"roomId": room.id}
+    )
+    new_message = message_factory.create(room=room, user=user)
+    recent_messages.add(new_message)
+    with django_assert_num_queries(0):
+        cached_response = client.get(
+            path=reverse("chat:get-messages"), data={"roomId": room.id}
+        )
+
+    assert len(first_response.data) == 3
+
+    assert cached_response.data[0]["id"] == new_message.id
+
+    assert len(cached_response.data) == 4
+
+
+@pytest.mark.django_db
+def test_is_room_active_view_cache(room_factory, client, django_assert_num_queries):
+    room = room_factory.create()
+
+    with django_assert_num_queries(1):
+        client.get(path=reverse("chat:is-room-active"), data={"code": room.code})
+        cached_response = client.get(
+            path=reverse("chat:is-room-active"), data={"code": room.code}
+        )
+
+    room.delete()
+    closed_room_response = client.get(
+        path=reverse("chat:is-room-active"), data={"code": room.code}
+    )
+
+    assert cached_response.status_code == 200
+
+    assert closed_room_response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_room_batch_views(
+    user_factory, room_factory, client, django_assert_num_queries
+):
+    user = user_factory.create()
+    rooms = room_factory.create_batch(size=3)
+    unknown_code = generate_room_code()
+    codes = ",".join([room.code for room in rooms] + [unknown_code])
+
+    client.force_authenticate(user)
+    with django_assert_num_queries(1):
+        details_response = client.get(
+            path=reverse("chat:get-room-details-batch"), data={"codes": codes}
+        )
+        active_response = client.get(
+            path=reverse("chat:is-room-active-batch"), data={"codes": codes}
+        )
+    too_many_response = client.get(
+        path=reverse("chat:is-room-active-batch"),
+        data={"codes": ",".join(generate_room_code() for _ in range(101))},
+    )
+
+    async def request():
+        return await AsyncClient().get(
+            f'{reverse("chat:async-is-room-active-batch")}?codes={codes}'
+        )
+
+    async_response = async_to_sync(request)()
+
+    assert details_response.status_code == 200
+
+    assert [details_response.data[room.code]["id"] for room in rooms] == [
+        room.id for room in rooms
+    ]
+
+    assert details_response.data[unknown_code] is None
+
+    expected = {**{room.code: True for room in rooms}, unknown_code: False}
+    assert active_response.data == expected
+
+    assert async_response.json() == expected
+
+    assert too_many_response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_metrics_view(room_factory, client, settings):
+    settings.CHAT_METRICS_TOKEN = "scrape"
+    room = room_factory.create()
+    client.get(path=reverse("chat:is-room-active"), data={"code": room.code})
+
+    response = client.get(
+        path=reverse("chat:metrics"), HTTP_AUTHORIZATION="Bearer scrape"
+    )
+
+    denied_response = client.get(
+        path=reverse("chat:metrics"), HTTP_AUTHORIZATION="Bearer wrong"
+    )
+
+    assert response.status_code == 200
+
+    assert denied_response.status_code == 403
+
+    assert (
+        'chat_http_request_seconds_count{view="IsRoomActive",method="GET"}'
+        in response.content.decode()
+    )
+
+
+@pytest.mark.django_db
+def test_async_room_views(user_factory, room_factory, message_factory):
+    host, user = user_factory.create_batch(size=2)
+    room = room_factory.create(host_id=host.id, max_participants=2)
+    message_factory.create_batch(size=3, room=room, user=host)
+    access_token = RefreshToken.for_user(user).access_token
+    # The async client of django 3.2 drops the data of GET
+    # requests, query strings are put in the urls instead
+    client = AsyncClient()
+    auth = {"authorization": f"Bearer {access_token}"}
+
+    async def requests():
+        return [
+            await client.get(
+                f'{reverse("chat:async-get-room-details")}?code={room.code}', **auth
+            ),
+            await client.put(
+                reverse("chat:async-join-room"),
+                {"code": room.code},
+                content_type="application/json",
+                **auth,
+            ),
+            await client.get(
+                f'{reverse("chat:async-get-messages")}?roomId={room.id}', **auth
+            ),
+            await client.put(
+                reverse("chat:async-leave-room"),
+                {"code": room.code},
+                content_type="application/json",
+                **auth,
+            ),
+            await client.get(f'{reverse("chat:async-is-room-active")}?code=AAAAAA'),
+            await client.get(
+                f'{reverse("chat:async-get-room-details")}?code={room.code}'
+            ),
+            await client.put(
+                reverse("chat:async-join-room"),
+                [room.code],
+                content_type="application/json",
+                **auth,
+            ),
+        ]
+
+    (
+        details,
+        joined,
+        messages,
+        left,
+        inactive,
+        anonymous,
+        not_an_object,
+    ) = async_to_sync(requests)()
+
+    assert details.json()["code"] == room.code
+
+    assert joined.json()["participants"] == 1
+
+    assert len(messages.json()) == 3
+
+    assert left.status_code == 200
+
+    assert Room.objects.get(id=room.id).participants == 0
+
+    assert inactive.status_code == 404
+
+    assert anonymous.status_code == 401
+
+    assert not_an_object.status_code == 400
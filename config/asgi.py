@@ -7,10 +7,10 @@ import django
 django.setup()
 
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
+from chat.middleware import JWTAuthMiddlewareStack
 import chat.routing
 
 
@@ -18,7 +18,7 @@ application = ProtocolTypeRouter(
     {
         "http": get_asgi_application(),
         "websocket": AllowedHostsOriginValidator(
-            AuthMiddlewareStack(URLRouter(chat.routing.websocket_urlpatterns))
+            JWTAuthMiddlewareStack(URLRouter(chat.routing.websocket_urlpatterns))
         ),
     }
 )
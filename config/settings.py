@@ -32,6 +32,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "chat.db.routers.replica_routing_middleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -63,16 +64,201 @@ WSGI_APPLICATION = "config.wsgi.application"
 ASGI_APPLICATION = "config.asgi.application"
 
 
-DATABASES = {"default": parse(os.getenv("DB_URL"))}
+DATABASES = {
+    "default": parse(
+        os.getenv("DB_URL"), conn_max_age=int(os.getenv("DB_CONN_MAX_AGE", 0))
+    )
+}
+
+# Comma separated urls of read replicas of the default database,
+# added as replica1, replica2... Reads are spread over them by
+# chat.db.routers.ReplicaRouter, writes go to default
+for index, url in enumerate(filter(None, os.getenv("DB_REPLICA_URLS", "").split(","))):
+    DATABASES[f"replica{index + 1}"] = dict(
+        parse(url, conn_max_age=int(os.getenv("DB_CONN_MAX_AGE", 0))),
+        TEST={"MIRROR": "default"},
+    )
+
+CHAT_DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+
+# Seconds the reads of a user go to the primary after the user
+# wrote, longer than the replication lag
+CHAT_REPLICA_STICKY_SECONDS = 5
+
+DATABASE_ROUTERS = ["chat.db.routers.ReplicaRouter"]
+
+# With DB_POOL_SIZE set, each process keeps a pool of that many
+# postgres connections per database shared by the request and
+# channels threads
+for database in DATABASES.values():
+    if os.getenv("DB_POOL_SIZE") and database["ENGINE"].endswith("postgresql"):
+        database.update(
+            ENGINE="chat.db.backends.postgresql",
+            CONN_MAX_AGE=0,
+            POOL={
+                "SIZE": int(os.getenv("DB_POOL_SIZE")),
+                "TIMEOUT": float(os.getenv("DB_POOL_TIMEOUT", 10)),
+                "CHECK_INTERVAL": float(os.getenv("DB_POOL_CHECK_INTERVAL", 30)),
+            },
+        )
 
 
+# The cache holds what all workers must agree on: cached rooms and
+# their invalidations, read-your-writes markers and taken seats.
+# It lives in Redis (REDIS_CACHE_URL, or REDIS_HOST) and only falls
+# back to a per-process cache when there is no Redis. Seat records
+# never expire, Redis must run with noeviction or a volatile-*
+# maxmemory-policy so they are not evicted
+if os.getenv("REDIS_CACHE_URL") or os.getenv("REDIS_HOST"):
+    CACHES = {
+        "default": {
+            "BACKEND": "chat.redis_cache.RedisCache",
+            "LOCATION": os.getenv("REDIS_CACHE_URL") or os.getenv("REDIS_HOST"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {"MAX_ENTRIES": 100000},
+        }
+    }
+
+# Room members on this process are reached in memory, Redis is
+# only used to reach other nodes and is left out without REDIS_HOST
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {"hosts": [os.getenv("REDIS_HOST")]},
+        "BACKEND": "chat.layers.LocalFanoutChannelLayer",
+        "CONFIG": {
+            "remote": {
+                "BACKEND": "channels_redis.core.RedisChannelLayer",
+                "CONFIG": {"hosts": [os.getenv("REDIS_HOST")]},
+            }
+            if os.getenv("REDIS_HOST")
+            else None,
+        },
     },
 }
 
+# Node id (0-31) in every message id generated by this process,
+# unique per process when several workers share a database. When
+# it is not set, each process leases a free one from the cache
+CHAT_NODE_ID = int(os.getenv("CHAT_NODE_ID")) if os.getenv("CHAT_NODE_ID") else None
+
+# Websocket frame codecs clients can pick with a chat.<codec> subprotocol
+CHAT_CODECS = ("json", "msgpack")
+
+CHAT_MESSAGE_BUFFER_SIZE = 100
+
+CHAT_MESSAGE_FLUSH_INTERVAL = 0.05
+
+# Failed message writes are retried until they succeed, with
+# backoff from CHAT_MESSAGE_RETRY_DELAY up to
+# CHAT_MESSAGE_RETRY_MAX_DELAY seconds. Meanwhile at most
+# CHAT_MESSAGE_BUFFER_LIMIT messages are queued, more are refused
+CHAT_MESSAGE_RETRY_DELAY = 0.5
+
+CHAT_MESSAGE_RETRY_MAX_DELAY = 30
+
+CHAT_MESSAGE_BUFFER_LIMIT = 10000
+
+CHAT_MESSAGE_PAGE_SIZE = 20
+
+CHAT_MESSAGE_MAX_PAGE_SIZE = 100
+
+# Recent messages kept in memory per room for get-messages/,
+# for at most CHAT_RECENT_MESSAGES_ROOMS rooms
+CHAT_RECENT_MESSAGES = 10
+
+CHAT_RECENT_MESSAGES_ROOMS = 1000
+
+CHAT_RECENT_MESSAGES_TTL = 5
+
+# Seconds a room looked up by code stays cached, 0 disables it
+CHAT_ROOM_CACHE_TTL = 2
+
+# Seconds the seat a user took with join-room is remembered for,
+# None keeps it until the user leaves or drops
+CHAT_SEAT_TTL = None
+
+# Seconds a user who left a room is remembered, a seat without a
+# record is only given back once in that time
+CHAT_SEAT_LEFT_TTL = 86400
+
+# Room codes one request to the batch room endpoints may ask for
+CHAT_BATCH_MAX_CODES = 100
+
+# Lets clients connected without an access token send messages
+# under the user id they name, for trusted clients only
+CHAT_ANONYMOUS_MESSAGES = False
+
+# Bearer token the scraper of metrics/ must send, the endpoint
+# is open when it is not set
+CHAT_METRICS_TOKEN = os.getenv("CHAT_METRICS_TOKEN")
+
+# Sends the lifecycle events of all rooms to signed in ws/lobby/
+# clients besides the members of each room. Off, ws/lobby/ refuses
+# connections, every room code would be sent to any user
+CHAT_LOBBY_EVENTS = False
+
+# Users whose websocket drops without a clean close get
+# CHAT_PRESENCE_GRACE seconds to reconnect before the seat they
+# took with join-room is released
+CHAT_PRESENCE_GRACE = 10
+
+CHAT_PRESENCE_FLUSH_INTERVAL = 1
+
+# (per second, burst) limits of the frames a connection and all
+# connections of a room may send. Events over the limit are merged
+# into the next allowed one, messages over the limit are refused
+CHAT_RATE_CONNECTION_EVENTS = (10, 20)
+
+CHAT_RATE_CONNECTION_MESSAGES = (5, 20)
+
+CHAT_RATE_ROOM_EVENTS = (50, 100)
+
+CHAT_RATE_ROOM_MESSAGES = (30, 60)
+
+# Read by the message_retention command. Messages of closed rooms
+# are cleaned up CHAT_CLOSED_ROOM_DELAY seconds after the room is
+# closed, messages older than CHAT_MESSAGE_RETENTION_DAYS are too
+# when it is set, and both are moved to the archive table unless
+# CHAT_ARCHIVE_MESSAGES is off
+CHAT_MESSAGE_RETENTION_DAYS = int(os.getenv("CHAT_MESSAGE_RETENTION_DAYS", 0)) or None
+
+CHAT_ARCHIVE_MESSAGES = True
+
+CHAT_RETENTION_CHUNK_SIZE = 1000
+
+CHAT_CLOSED_ROOM_DELAY = 60
+
+# Messages per room kept in memory for clients that reconnect
+# with ?last_seen_id=, older gaps are read from the database, at
+# most CHAT_REPLAY_LIMIT messages
+CHAT_REPLAY_SIZE = 200
+
+CHAT_REPLAY_LIMIT = 500
+
+# Rooms one multiplexed ws/chat/ connection may subscribe to
+CHAT_MULTIPLEX_MAX_ROOMS = 50
+
+# Seconds events of a room are collected before they are sent
+# together, events of one type from one user keep the latest,
+# 0 sends every event on its own
+CHAT_EVENT_TICK = 0.1
+
+# Limits of inbound websocket frames. A frame may be at most
+# CHAT_MAX_FRAME_SIZE characters or bytes, message text at most
+# CHAT_MAX_MESSAGE_LENGTH characters, and events flat objects of
+# CHAT_MAX_EVENT_FIELDS fields
+CHAT_MAX_FRAME_SIZE = 16384
+
+CHAT_MAX_MESSAGE_LENGTH = 2000
+
+CHAT_MAX_EVENT_FIELDS = 8
+
+CHAT_MAX_EVENT_VALUE_LENGTH = 256
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
@@ -104,8 +290,10 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 CORS_ALLOW_ALL_ORIGINS = True
 
 REST_FRAMEWORK = {
+    # Users are built from the validated token claims, the
+    # api never loads them from the database
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "rest_framework_simplejwt.authentication.JWTStatelessUserAuthentication",
     ),
     "NON_FIELD_ERRORS_KEY": "error",
 }